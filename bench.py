@@ -0,0 +1,289 @@
+"""
+Нагрузочный бенчмарк бота без сети.
+
+Синтетические пользователи проходят весь сценарий RequestStates (новая заявка
+с сохранением шаблона и заявка из шаблона) через Dispatcher.feed_update.
+Вместо Telegram используется сессия, которая только записывает вызовы API.
+
+Запуск:
+    python bench.py --users 2000 --concurrency 500 --out bench_results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import sys
+import tempfile
+import resource
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TARGET_CHAT_ID = -1000000000001
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[idx]
+
+
+def peak_rss_mb() -> float:
+    # пиковый RSS процесса: tracemalloc замедлил бы замеряемый прогон в разы
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def prepare_env(workdir: str):
+    # main читает настройки при импорте, поэтому окружение готовим заранее
+    os.environ.setdefault("TGTOKEN", "123456:BENCH")
+    os.environ["TARGET_CHAT_ID"] = str(TARGET_CHAT_ID)
+    os.environ["DB_FILE"] = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("PUBLISH_RATE_PER_MIN", "1000000")
+    os.environ.setdefault("PUBLISH_BURST", "1000000")
+    os.environ.setdefault("PUBLISH_GLOBAL_RATE", "1000000")
+    # личные лимиты не должны срабатывать: синтетический пользователь шлёт апдейты без пауз
+    for name in ("THROTTLE_MESSAGE_BURST", "THROTTLE_CALLBACK_BURST", "THROTTLE_PUBLISH_BURST"):
+        os.environ.setdefault(name, "1000000")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+
+def build_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class RecordingSession(BaseSession):
+        """Сессия без сети: считает вызовы API и возвращает правдоподобные ответы."""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] += 1
+            # правка сообщения в чате возвращает Message (True — только для inline-сообщений);
+            # на это опирается, например, дайджест, дописывающий заявки в свой пост
+            edited = name.startswith("Edit") and not getattr(method, "inline_message_id", None)
+            if method.__returning__ is Message or name.startswith("Send") or edited:
+                chat_id = getattr(method, "chat_id", None) or 0
+                return Message(
+                    message_id=method.message_id if edited else next(self.message_ids),
+                    date=datetime.datetime.now(),
+                    chat=Chat(id=chat_id, type="private" if chat_id > 0 else "supergroup"),
+                    text=getattr(method, "text", None),
+                )
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return RecordingSession
+
+
+class Scenario:
+    """Генератор апдейтов для одного синтетического пользователя."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User{user_id}",
+            "username": f"user{user_id}",
+        }
+        self.chat = {"id": user_id, "type": "private"}
+
+    def message(self, text: str) -> dict:
+        return {
+            "update_id": next(self._ids),
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": self.chat,
+                "from": self.user,
+                "text": text,
+            },
+        }
+
+    def callback(self, data: str) -> dict:
+        return {
+            "update_id": next(self._ids),
+            "callback_query": {
+                "id": str(next(self._ids)),
+                "chat_instance": str(self.user_id),
+                "from": self.user,
+                "data": data,
+                "message": {
+                    "message_id": next(self._ids),
+                    "date": int(time.time()),
+                    "chat": self.chat,
+                    "text": "preview",
+                },
+            },
+        }
+
+    def full_flow(self) -> list:
+        direction = "Принять RUB" if self.user_id % 2 else "Отправить RUB"
+        conditions = "Чек PDF" if direction == "Принять RUB" else "Одним платежом"
+        return [
+            self.message("/start"),
+            self.message(direction),
+            self.message(f"{100000 + self.user_id}\n200000-300000"),
+            self.message("83,15"),
+            self.message("Только Сбербанк"),
+            self.message("Личная карта"),
+            self.message("Bybit"),
+            self.message(conditions),
+            self.message("Использовать текущий контакт"),
+            self.callback("publish_request"),
+            self.callback("save_template"),
+            self.message(f"Шаблон {self.user_id}"),
+        ]
+
+    def template_flow(self, template_callback: str) -> list:
+        return [
+            self.message("/start"),
+            self.message("Использовать шаблон"),
+            self.callback(template_callback),
+            self.message("50000"),
+            self.message("84"),
+            self.message("Использовать текущий контакт"),
+            self.callback("publish_request"),
+            self.callback("no_template"),
+        ]
+
+
+async def run(args) -> dict:
+    import main
+    from aiogram import BaseMiddleware, Bot
+    from aiogram.types import Update
+
+    latencies = defaultdict(list)
+    errors = Counter()
+
+    class TimingMiddleware(BaseMiddleware):
+        async def __call__(self, handler, event, data):
+            name = data["handler"].callback.__name__
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                latencies[name].append(time.perf_counter() - started)
+
+    session = build_session_class()()
+    bot = Bot(token=os.environ["TGTOKEN"], session=session)
+    dp = main.create_dispatcher()
+    dp.message.middleware(TimingMiddleware())
+    dp.callback_query.middleware(TimingMiddleware())
+
+    await dp.emit_startup(bot=bot)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    completed = 0
+    updates = 0
+
+    async def feed(raw: dict):
+        nonlocal updates
+        update = Update.model_validate(raw, context={"bot": bot})
+        await dp.feed_update(bot, update)
+        updates += 1
+
+    async def walk(user_id: int):
+        nonlocal completed
+        scenario = Scenario(user_id)
+        async with semaphore:
+            for raw in scenario.full_flow():
+                await feed(raw)
+            completed += 1
+            if user_id % 100 < args.template_percent:
+                templates = main.templates_store.get(user_id)
+                template_callback = f"{main.TEMPLATE_SELECT_PREFIX}{templates[-1]['id']}"
+                for raw in scenario.template_flow(template_callback):
+                    await feed(raw)
+                completed += 1
+
+    baseline_rss = peak_rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(walk(args.user_base + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    # ждём, пока очередь публикаций разгребёт всё поставленное
+    drain_started = time.perf_counter()
+    while main.publish_queue.pending(TARGET_CHAT_ID) and time.perf_counter() - drain_started < 60:
+        await asyncio.sleep(0.05)
+    peak_rss = peak_rss_mb()
+
+    await dp.emit_shutdown(bot=bot)
+
+    api_calls = sum(session.calls.values())
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "elapsed_sec": round(elapsed, 3),
+        "updates": updates,
+        "completed_requests": completed,
+        "updates_per_sec": round(updates / elapsed, 1) if elapsed else 0,
+        "requests_per_sec": round(completed / elapsed, 1) if elapsed else 0,
+        "api_calls": dict(session.calls),
+        "api_calls_per_request": round(api_calls / completed, 2) if completed else 0,
+        # счётчики событий бота: сбои слушателей очереди, повторы и т.п. видно здесь
+        "events": dict(main.metrics.events),
+        "peak_memory_mb": round(peak_rss, 2),
+        "memory_growth_mb": round(peak_rss - baseline_rss, 2),
+        "handlers": {
+            name: {
+                "count": len(values),
+                "errors": errors[name],
+                "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+            for name, values in sorted(latencies.items())
+        },
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк сценария заявок")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--template-percent", type=int, default=50,
+                        help="доля пользователей (в %%), которые создают вторую заявку из шаблона")
+    parser.add_argument("--user-base", type=int, default=10 ** 6)
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench_results.json"))
+    args = parser.parse_args()
+    out = os.path.abspath(args.out)
+
+    with tempfile.TemporaryDirectory(prefix="zayavki-bench-") as workdir:
+        prepare_env(workdir)
+        result = asyncio.run(run(args))
+
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"{result['completed_requests']} заявок за {result['elapsed_sec']} с "
+          f"({result['requests_per_sec']} заявок/с, {result['updates_per_sec']} апдейтов/с)")
+    print(f"API-вызовов на заявку: {result['api_calls_per_request']}, "
+          f"пик RSS: {result['peak_memory_mb']} МБ (+{result['memory_growth_mb']} МБ за прогон)")
+    for name, stats in result["handlers"].items():
+        print(f"  {name:28} n={stats['count']:<7} p50={stats['p50_ms']:.3f} мс "
+              f"p99={stats['p99_ms']:.3f} мс")
+    print(f"Результаты сохранены в {out}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,14 +1,49 @@
 import os
 import asyncio
+import bisect
+import csv
+import fcntl
+import heapq
+import html
 import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import random
+import re
+import signal
+import sqlite3
+import tempfile
+import time
+import weakref
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
 from pathlib import Path
+from types import MappingProxyType
+from aiohttp import web
 from dotenv import load_dotenv
 load_dotenv()
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode, ChatType
-from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -16,61 +51,3204 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent,
+    FSInputFile,
 )
 
-# ==========================
-# НАСТРОЙКИ
-# =========================
+# ==========================
+# НАСТРОЙКИ
+# =========================
+
+BOT_TOKEN = os.getenv("TGTOKEN")
+#TARGET_CHAT_ID = -1002909872942 # id чата для публикации заявок
+TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "0"))
+# маршруты публикации: JSON-файл со списком {"chat_id", "thread_id"?, "direction"?,
+# "exchange"?, "bank"?}, условие — строка или список строк. Заявка уходит по всем
+# подходящим маршрутам, в каждый чат — один раз (по первому подходящему).
+# Без файла — единственный маршрут в TARGET_CHAT_ID.
+ROUTES_FILE = os.getenv("ROUTES_FILE", "")
+
+# режим получения обновлений: polling (по умолчанию), webhook или sharded —
+# фронт (вебхук, если задан WEBHOOK_URL, иначе polling) раздаёт апдейты
+# SHARDS процессам-воркерам по user_id % SHARDS
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+SHARDS = max(1, int(os.getenv("SHARDS", "4"))) if RUN_MODE == "sharded" else 1
+# номер шарда текущего процесса; воркерам его выставляет run_shard()
+SHARD_INDEX = 0
+# публичный адрес для setWebhook, например https://bot.example.com;
+# если пусто, вебхук в Telegram не регистрируется (удобно для локальных тестов)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+COUNTER_FILE = "counter.json"
+# сколько номеров заявок резервируем за одну запись на диск
+REQUEST_ID_BLOCK = int(os.getenv("REQUEST_ID_BLOCK", "50"))
+TEMPLATES_FILE = "templates.json"
+# через сколько секунд после изменения шаблоны сбрасываются на диск
+TEMPLATES_FLUSH_DELAY = float(os.getenv("TEMPLATES_FLUSH_DELAY", "2"))
+# неудачная запись повторяется с удвоением паузы, но не реже чем раз в столько секунд
+TEMPLATES_FLUSH_MAX_BACKOFF = 300
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+# черновики заявок, к которым не возвращались дольше FSM_TTL секунд, удаляются
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 60 * 60)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+# лимиты Telegram: ~20 сообщений в минуту в одну группу и ~30 в секунду на бота
+PUBLISH_RATE_PER_MIN = float(os.getenv("PUBLISH_RATE_PER_MIN", "20"))
+PUBLISH_BURST = int(os.getenv("PUBLISH_BURST", "3"))
+PUBLISH_GLOBAL_RATE = float(os.getenv("PUBLISH_GLOBAL_RATE", "25"))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", "5"))
+# режим дайджеста: заявки, пришедшие в течение DIGEST_WINDOW секунд, собираются
+# в одно сообщение (дописываются правкой), пока оно короче DIGEST_MAX_CHARS;
+# 0 — каждая заявка отдельным сообщением
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "0"))
+DIGEST_MAX_CHARS = int(os.getenv("DIGEST_MAX_CHARS", "3800"))
+# метрики в формате Prometheus на локальном порту; 0 — не поднимать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# одновременно выполняемых хэндлеров на все апдейты; сверх SHED_BACKLOG
+# принятых апдейтов (или USER_LANE_DEPTH от одного пользователя) — «занято»
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "100"))
+SHED_BACKLOG = int(os.getenv("SHED_BACKLOG", "2000"))
+USER_LANE_DEPTH = int(os.getenv("USER_LANE_DEPTH", "10"))
+# личные лимиты пользователя (token bucket): сообщений, нажатий кнопок и публикаций
+# в минуту и запас на всплеск; в памяти не больше THROTTLE_MAX_BUCKETS корзин
+THROTTLE_MESSAGES_PER_MIN = float(os.getenv("THROTTLE_MESSAGES_PER_MIN", "30"))
+THROTTLE_MESSAGE_BURST = float(os.getenv("THROTTLE_MESSAGE_BURST", "10"))
+THROTTLE_CALLBACKS_PER_MIN = float(os.getenv("THROTTLE_CALLBACKS_PER_MIN", "60"))
+THROTTLE_CALLBACK_BURST = float(os.getenv("THROTTLE_CALLBACK_BURST", "20"))
+THROTTLE_PUBLISHES_PER_MIN = float(os.getenv("THROTTLE_PUBLISHES_PER_MIN", "2"))
+THROTTLE_PUBLISH_BURST = float(os.getenv("THROTTLE_PUBLISH_BURST", "3"))
+THROTTLE_MAX_BUCKETS = int(os.getenv("THROTTLE_MAX_BUCKETS", "200000"))
+# защита от повторов: сколько секунд помнить update_id и отметки о публикации
+# (повторное нажатие «Опубликовать»), и сколько ключей держать в памяти
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL_SEC", "600"))
+PUBLISH_MARK_TTL = int(os.getenv("PUBLISH_MARK_TTL_HOURS", "72")) * 3600
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "50000"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PUBLISH_CB = "publish_request"
+CANCEL_CB = "cancel_request"
+SAVE_TEMPLATE_CB = "save_template"
+NO_TEMPLATE_CB = "no_template"
+TEMPLATE_SELECT_PREFIX = "ts:"
+DELETE_TEMPLATE_PREFIX = "td:"
+TEMPLATE_PAGE_PREFIX = "tp:"
+# кнопки шаблонов старого формата (по позиции в списке)
+LEGACY_TEMPLATE_PREFIXES = ("tpl:", "dtpl:")
+TEMPLATES_PAGE_SIZE = int(os.getenv("TEMPLATES_PAGE_SIZE", "8"))
+MY_PAGE_PREFIX = "my:"
+CLOSE_REQUEST_PREFIX = "close:"
+QUICK_PUBLISH_PREFIX = "qp:"
+UNSUBSCRIBE_PREFIX = "unsub:"
+# кнопка «Отписаться» под уведомлением о заявке
+NOTIFY_UNSUBSCRIBE_PREFIX = "nunsub:"
+# подписки на новые заявки: сколько можно завести одному пользователю и
+# сколько личных уведомлений в секунду бот отправляет (на все шарды вместе)
+SUBSCRIPTIONS_PER_USER = int(os.getenv("SUBSCRIPTIONS_PER_USER", "10"))
+NOTIFY_RATE_PER_SEC = float(os.getenv("NOTIFY_RATE_PER_SEC", "10"))
+NOTIFY_QUEUE_LIMIT = int(os.getenv("NOTIFY_QUEUE_LIMIT", "100000"))
+# id администраторов через запятую: им доступны /export и /import
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x)
+# по сколько строк импорт пишет в базу за раз и сколько номеров негодных строк показать
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "500"))
+IMPORT_BAD_SHOWN = 20
+# сколько секунд Telegram может отдавать inline-результаты из своего кэша
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+MY_PAGE_SIZE = int(os.getenv("MY_PAGE_SIZE", "5"))
+# сколько встречных заявок показывать автору после публикации
+MATCH_LIMIT = int(os.getenv("MATCH_LIMIT", "5"))
+MATCH_SCAN_LIMIT = int(os.getenv("MATCH_SCAN_LIMIT", "200"))
+# сколько заявок показывать в ответ на /find
+FIND_LIMIT = int(os.getenv("FIND_LIMIT", "10"))
+# закреплённое табло с лучшими курсами в TARGET_CHAT_ID
+BOARD_ENABLED = os.getenv("BOARD_ENABLED", "0") == "1"
+# не чаще одного редактирования табло за BOARD_INTERVAL секунд
+BOARD_INTERVAL = float(os.getenv("BOARD_INTERVAL", "30"))
+# счётчики /stats: раз в STATS_FLUSH_INTERVAL секунд сбрасываются в базу;
+# почасовые храним STATS_HOURLY_DAYS дней, посуточные — всегда
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "60"))
+STATS_HOURLY_DAYS = int(os.getenv("STATS_HOURLY_DAYS", "14"))
+# через сколько часов опубликованная заявка истекает; 0 — не истекает
+REQUEST_TTL = float(os.getenv("REQUEST_TTL_HOURS", "0")) * 3600
+# что делать с постом истёкшей заявки: edit (пометить «неактуально») или delete
+EXPIRE_MODE = os.getenv("EXPIRE_MODE", "edit")
+# раз в сколько часов переопубликовывать открытую заявку; 0 — не поднимать
+BUMP_INTERVAL = float(os.getenv("BUMP_INTERVAL_HOURS", "0")) * 3600
+# сколько заявок держать в памяти индекса постов и сколько дней хранить посты
+POST_CACHE_SIZE = int(os.getenv("POST_CACHE_SIZE", "10000"))
+POST_RETENTION = float(os.getenv("POST_RETENTION_DAYS", "30")) * 86400
+
+# ==========================
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ==========================
+
+log = logging.getLogger("zayavki_bot")
+
+
+def to_base36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+
+def load_json(path: str, default):
+    """
+    default — только если файла нет. Битый файл — ошибка (ValueError): иначе
+    следующая запись перезаписала бы его пустыми данными.
+    """
+    p = Path(path)
+    if not p.exists():
+        return default
+    return json.loads(p.read_text(encoding="utf-8"))
+
+
+def save_json(path: str, data):
+    """
+    Атомарная запись: пишем во временный файл рядом, fsync и rename.
+    При падении посередине на диске остаётся либо старая, либо новая версия.
+    """
+    p = Path(path)
+    tmp = p.with_name(f".{p.name}.tmp")
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, p)
+    dir_fd = os.open(p.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Эксклюзивный flock на файл-спутник .<имя>.lock — защита от других процессов."""
+    p = Path(path)
+    lock_path = p.with_name(f".{p.name}.lock")
+    with open(lock_path, "a+") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class RequestIdAllocator:
+    """
+    Выдаёт номера заявок из арендованного блока в памяти.
+    На диск пишется только верхняя граница блока, поэтому после рестарта
+    выдача продолжается с новой границы и номера никогда не повторяются
+    (неиспользованный хвост старого блока просто пропускается).
+    """
+
+    def __init__(self, path: str, block_size: int):
+        self.path = path
+        self.block_size = max(1, block_size)
+        self._next = 0
+        self._limit = 0
+        # следующий блок арендуется заранее, когда текущий израсходован наполовину
+        self._spare = None
+        self._leasing = None
+        # номера до _floor заняты импортом — их не выдаём даже из своих блоков
+        self._floor = 0
+
+    def _lease(self) -> int:
+        # выполняется в отдельном потоке; flock защищает от других процессов
+        p = Path(self.path)
+        with file_lock(self.path):
+            last_id = 0
+            if p.exists():
+                # битый счётчик — это ошибка, а не повод начать нумерацию с нуля
+                data = json.loads(p.read_text(encoding="utf-8"))
+                last_id = int(data.get("last_id", 0))
+            limit = last_id + self.block_size
+            save_json(self.path, {"last_id": limit})
+            return last_id
+
+    def _raise_floor(self, floor: int):
+        p = Path(self.path)
+        with file_lock(self.path):
+            last_id = int(json.loads(p.read_text(encoding="utf-8")).get("last_id", 0)) if p.exists() else 0
+            if last_id < floor:
+                save_json(self.path, {"last_id": floor})
+
+    async def advance(self, floor: int):
+        """Номера до floor включительно заняты (например, импортом) — больше их не выдавать."""
+        await asyncio.to_thread(self._raise_floor, floor)
+        self.forget_below(floor)
+
+    def forget_below(self, floor: int):
+        """
+        Отбрасывает номера до floor из уже арендованных блоков. Хвост блока выше
+        floor остаётся нашим: общий счётчик не меньше конца любого выданного блока.
+        """
+        self._floor = max(self._floor, floor)
+        if self._next < self._floor:
+            self._next = min(self._floor, self._limit)
+        if self._spare is not None:
+            self._spare = self._trim(self._spare)
+
+    def _trim(self, block: tuple):
+        start, limit = max(block[0], self._floor), block[1]
+        return (start, limit) if start < limit else None
+
+    async def _refill(self):
+        try:
+            start = await asyncio.to_thread(self._lease)
+            # пока блок арендовался, floor мог подняться
+            self._spare = self._trim((start, start + self.block_size))
+        finally:
+            self._leasing = None
+
+    async def next_id(self) -> int:
+        # выдача из блока идёт без await, поэтому атомарна в рамках event loop;
+        # ждать приходится только когда и текущий, и запасной блок кончились
+        while self._next >= self._limit:
+            if self._spare is not None:
+                self._next, self._limit = self._spare
+                self._spare = None
+                break
+            if self._leasing is None:
+                self._leasing = asyncio.ensure_future(self._refill())
+            await asyncio.shield(self._leasing)
+        self._next += 1
+        if (
+            self._spare is None
+            and self._leasing is None
+            and self._limit - self._next < self.block_size // 2
+        ):
+            self._leasing = asyncio.ensure_future(self._refill())
+        return self._next
+
+
+request_ids = RequestIdAllocator(COUNTER_FILE, REQUEST_ID_BLOCK)
+
+
+async def get_next_request_id() -> int:
+    return await request_ids.next_id()
+
+
+class TemplateStore:
+    """
+    Шаблоны всех пользователей в памяти: файл читается один раз,
+    изменения сериализуются по пользователю и пишутся на диск пачкой
+    через TEMPLATES_FLUSH_DELAY секунд после первого изменения.
+    При записи под flock в файл вливаются только изменённые пользователи,
+    так что несколько процессов (шардов) не затирают шаблоны друг друга.
+    У каждого шаблона постоянный короткий id (base36) из счётчика пользователя,
+    который только растёт: id удалённого шаблона больше никому не достаётся.
+    Поиск по id — через словарь, который строится лениво.
+    В файле у пользователя {"next_id": n, "items": [...]}; старый формат
+    (просто список шаблонов) читается и переписывается при первом изменении.
+    """
+
+    def __init__(self, path: str, flush_delay: float):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._data = None
+        # user_id (str) -> последний выданный id шаблона
+        self._next_ids = {}
+        self._locks = weakref.WeakValueDictionary()
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock()
+        self._dirty = set()
+        # подряд неудачных записей — от них зависит пауза перед повтором
+        self._failures = 0
+        # вызываются с user_id при любом изменении его шаблонов
+        self.listeners = []
+        # user_id (str) -> {id шаблона: шаблон}
+        self._indexes = {}
+
+    def _read(self) -> dict:
+        users = load_json(self.path, {})
+        if not isinstance(users, dict):
+            raise ValueError(f"{self.path}: ожидался объект JSON")
+        return users
+
+    def _users(self) -> dict:
+        if self._data is None:
+            data = {}
+            for key, entry in self._read().items():
+                if isinstance(entry, list):
+                    entry = {"next_id": 0, "items": entry}
+                templates = entry["items"]
+                if any("id" not in tpl for tpl in templates):
+                    templates = self._with_ids(templates)
+                self._next_ids[key] = max(
+                    [int(entry.get("next_id", 0))] + [int(tpl["id"], 36) for tpl in templates]
+                )
+                if templates:
+                    data[key] = templates
+            self._data = data
+        return self._data
+
+    @staticmethod
+    def _with_ids(templates: list) -> list:
+        # шаблоны из старых версий без id — нумеруем по порядку, детерминированно
+        # (одинаково во всех процессах), после уже выданных id
+        next_id = max((int(tpl["id"], 36) for tpl in templates if "id" in tpl), default=0)
+        result = []
+        for tpl in templates:
+            if "id" not in tpl:
+                next_id += 1
+                tpl = dict(tpl, id=to_base36(next_id))
+            result.append(tpl)
+        return result
+
+    def _index(self, key: str) -> dict:
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = {tpl["id"]: tpl for tpl in self._users().get(key, [])}
+        return index
+
+    def load(self):
+        self._users()
+
+    def read_file(self) -> dict:
+        """
+        Шаблоны всех пользователей из файла, а не из памяти: у шарда в памяти
+        чужие пользователи такие, какими были при его старте. user_id -> список.
+        """
+        with file_lock(self.path):
+            users = self._read()
+        return {key: entry if isinstance(entry, list) else entry["items"] for key, entry in users.items()}
+
+    def get(self, user_id: int) -> list:
+        # копия списка: вызывающий код не должен менять хранилище в обход блокировки
+        return list(self._users().get(str(user_id), []))
+
+    def count(self, user_id: int) -> int:
+        return len(self._users().get(str(user_id), ()))
+
+    def page(self, user_id: int, offset: int, limit: int) -> list:
+        return self._users().get(str(user_id), [])[offset:offset + limit]
+
+    def find(self, user_id: int, template_id: str):
+        return self._index(str(user_id)).get(template_id)
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        return lock
+
+    async def add(self, user_id: int, template: dict) -> dict:
+        """Сохраняет шаблон с новым id и возвращает его."""
+        async with self._lock(user_id):
+            users = self._users()
+            key = str(user_id)
+            self._next_ids[key] = self._next_ids.get(key, 0) + 1
+            template = dict(template, id=to_base36(self._next_ids[key]))
+            users[key] = users.get(key, []) + [template]
+            self._mark_dirty(user_id)
+            return template
+
+    async def remove(self, user_id: int, template_id: str):
+        """Удаляет шаблон по id и возвращает его (или None)."""
+        async with self._lock(user_id):
+            users = self._users()
+            removed = self.find(user_id, template_id)
+            if removed is None:
+                return None
+            templates = [tpl for tpl in users.get(str(user_id), []) if tpl["id"] != template_id]
+            if templates:
+                users[str(user_id)] = templates
+            else:
+                users.pop(str(user_id), None)
+            self._mark_dirty(user_id)
+            return removed
+
+    def _mark_dirty(self, user_id: int):
+        self._dirty.add(str(user_id))
+        self._indexes.pop(str(user_id), None)
+        for listener in self.listeners:
+            listener(user_id)
+        if self._flush_handle is None:
+            self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self._flush_later())
+        )
+
+    async def _flush_later(self):
+        # запись по таймеру: её никто не ждёт, поэтому ошибку логируем здесь
+        # и повторяем с нарастающей паузой, пока изменения не лягут на диск
+        try:
+            await self.flush()
+        except Exception:
+            self._failures += 1
+            metrics.inc("templates_flush_failed")
+            delay = min(self.flush_delay * 2 ** self._failures, TEMPLATES_FLUSH_MAX_BACKOFF)
+            log.exception("Не удалось записать %s, повтор через %.1f с", self.path, delay)
+            if self._dirty and self._flush_handle is None:
+                self._schedule_flush(delay)
+        else:
+            self._failures = 0
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # списки шаблонов не меняются на месте, поэтому ссылок достаточно
+            users = self._users()
+            # счётчик пишется и без шаблонов: иначе id удалённых выдались бы снова
+            changes = {
+                key: {"next_id": self._next_ids.get(key, 0), "items": users.get(key, [])}
+                for key in dirty
+            }
+            try:
+                await asyncio.to_thread(self._merge, changes)
+            except Exception:
+                self._dirty |= dirty
+                raise
+
+    def _merge(self, changes: dict):
+        with file_lock(self.path):
+            users = self._read()
+            users.update(changes)
+            save_json(self.path, users)
+
+    async def close(self):
+        await self.flush()
+
+
+templates_store = TemplateStore(TEMPLATES_FILE, TEMPLATES_FLUSH_DELAY)
+
+
+class Database:
+    """
+    Обёртка над SQLite: одно соединение и один фоновый поток,
+    все запросы выполняются вне event loop и строго по очереди.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+        return self._conn
+
+    async def run(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке базы."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: fn(self._connection(), *args)
+        )
+
+    async def execute(self, sql: str, params=()):
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute)
+
+    async def executemany(self, sql: str, rows):
+        def _executemany(conn):
+            with conn:
+                conn.executemany(sql, rows)
+        await self.run(_executemany)
+
+    async def executescript(self, script: str):
+        await self.run(lambda conn: conn.executescript(script))
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def ensure_column(self, table: str, column: str, decl: str):
+        """ALTER TABLE ADD COLUMN для баз, созданных до появления колонки."""
+        def _ensure(conn):
+            names = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if column not in names:
+                with conn:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        await self.run(_ensure)
+
+    @staticmethod
+    def _meta_table(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    async def get_meta(self, key: str, default=None):
+        """Небольшие служебные значения (id сообщений и т.п.), хранятся как JSON."""
+        def _get(conn):
+            self._meta_table(conn)
+            return conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        row = await self.run(_get)
+        return json.loads(row[0]) if row else default
+
+    async def set_meta(self, key: str, value):
+        def _set(conn):
+            with conn:
+                self._meta_table(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    (key, json.dumps(value)),
+                )
+        await self.run(_set)
+
+    async def close(self):
+        def _close(conn):
+            conn.close()
+        if self._conn is not None:
+            await self.run(_close)
+            self._conn = None
+
+
+db = Database(DB_FILE)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite. Сессии подгружаются лениво, в памяти держится
+    ограниченный LRU-кэш активных. Черновики, к которым не возвращались
+    дольше ttl секунд, удаляются фоновой чисткой.
+
+    Запись групповая: изменения, накопившиеся, пока идёт предыдущая транзакция,
+    уходят следующей одной транзакцией, и каждый вызов ждёт её коммита.
+    """
+
+    def __init__(self, database: Database, ttl: int, cache_size: int, sweep_interval: int):
+        self.db = database
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.sweep_interval = sweep_interval
+        # StorageKey -> [state, data, updated_at]
+        self._cache = OrderedDict()
+        self._ready = False
+        self._sweeper = None
+        # ключ -> (state, data_json, updated_at) или None для удаления
+        self._pending = {}
+        self._writing = {}
+        self._next_batch = None
+        self._writer = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (
+            f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{key.business_connection_id or ''}:{key.destiny}"
+        )
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at);
+            """
+        )
+        if self.ttl > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _record(self, key: StorageKey) -> list:
+        await self._prepare()
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+        else:
+            skey = self._key(key)
+            if skey in self._pending or skey in self._writing:
+                # запись ещё не закоммичена — берём её, а не старую строку из базы
+                row = self._pending.get(skey, self._writing.get(skey))
+                row = (None, "{}", time.time()) if row is None else row
+            else:
+                row = await self.db.fetchone(
+                    "SELECT state, data, updated_at FROM fsm WHERE key = ?", (skey,)
+                )
+            record = self._cache.get(key)
+            if record is None:
+                if row is None or self._expired(row[2]):
+                    record = [None, {}, time.time()]
+                else:
+                    record = [row[0], json.loads(row[1]), row[2]]
+                self._cache[key] = record
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if self._expired(record[2]):
+            record[0], record[1] = None, {}
+        return record
+
+    def _expired(self, updated_at: float) -> bool:
+        return self.ttl > 0 and time.time() - updated_at > self.ttl
+
+    async def _save(self, key: StorageKey, record: list):
+        record[2] = time.time()
+        if record[0] is None and not record[1]:
+            # пустая сессия: хранить нечего
+            self._cache.pop(key, None)
+            self._pending[self._key(key)] = None
+        else:
+            self._pending[self._key(key)] = (
+                record[0], json.dumps(record[1], ensure_ascii=False), record[2]
+            )
+        if self._next_batch is None:
+            self._next_batch = asyncio.get_running_loop().create_future()
+            if self._writer is None or self._writer.done():
+                self._writer = asyncio.create_task(self._write_loop())
+        await asyncio.shield(self._next_batch)
+
+    async def _write_loop(self):
+        while self._pending:
+            self._writing, self._pending = self._pending, {}
+            batch, self._next_batch = self._next_batch, None
+            try:
+                await self.db.run(self._write_rows, self._writing)
+            except Exception as e:
+                batch.set_exception(e)
+            else:
+                batch.set_result(None)
+            finally:
+                self._writing = {}
+
+    @staticmethod
+    def _write_rows(conn, rows: dict):
+        with conn:
+            conn.executemany(
+                "DELETE FROM fsm WHERE key = ?",
+                [(k,) for k, v in rows.items() if v is None],
+            )
+            conn.executemany(
+                "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                [(k, *v) for k, v in rows.items() if v is not None],
+            )
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._save(key, record)
+
+    async def get_state(self, key: StorageKey):
+        record = await self._record(key)
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        record = await self._record(key)
+        record[1] = dict(data)
+        await self._save(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = await self._record(key)
+        return dict(record[1])
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                pass
+
+    async def sweep(self):
+        """Удаляет брошенные черновики из кэша и из базы."""
+        deadline = time.time() - self.ttl
+        for key in [k for k, r in self._cache.items() if r[2] < deadline]:
+            del self._cache[key]
+        await self.db.execute("DELETE FROM fsm WHERE updated_at < ?", (deadline,))
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # последняя ячейка — всё, что больше самой большой границы
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            yield le, total
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы задержек в памяти процесса: по хэндлерам
+    (с разбивкой по состоянию FSM), по методам Bot API и именованные события.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # (handler, state) -> [count, errors, Histogram]
+        self.handlers = {}
+        # method -> [count, errors, Histogram]
+        self.api = {}
+        self.events = Counter()
+        # name -> функция без аргументов, значение снимается при отдаче метрик
+        self.gauges = {}
+
+    def _observe(self, table: dict, key, seconds: float, error: bool):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [0, 0, Histogram(self.buckets)]
+        entry[0] += 1
+        if error:
+            entry[1] += 1
+        entry[2].observe(seconds)
+
+    def observe_handler(self, handler: str, state, seconds: float, error: bool = False):
+        self._observe(self.handlers, (handler, state or ""), seconds, error)
+
+    def observe_api(self, method: str, seconds: float, error: bool = False):
+        self._observe(self.api, method, seconds, error)
+
+    def inc(self, event: str, value: int = 1):
+        self.events[event] += value
+
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        def entry(e):
+            return {"count": e[0], "errors": e[1], "sum": e[2].sum}
+        return {
+            "handlers": {f"{h}|{s}": entry(e) for (h, s), e in self.handlers.items()},
+            "api": {m: entry(e) for m, e in self.api.items()},
+            "events": dict(self.events),
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+    def reset(self):
+        self.handlers.clear()
+        self.api.clear()
+        self.events.clear()
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        parts = []
+        for name, value in labels.items():
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{name}="{value}"')
+        return "{" + ",".join(parts) + "}"
+
+    def _render_table(self, lines: list, name: str, help_text: str, table: dict, label_names):
+        lines.append(f"# HELP {name}_seconds {help_text}")
+        lines.append(f"# TYPE {name}_seconds histogram")
+        for key, (count, errors, hist) in table.items():
+            labels = dict(zip(label_names, key if isinstance(key, tuple) else (key,)))
+            for le, total in hist.cumulative():
+                le_label = "+Inf" if le == float("inf") else repr(le)
+                lines.append(f"{name}_seconds_bucket{self._labels(**labels, le=le_label)} {total}")
+            lines.append(f"{name}_seconds_sum{self._labels(**labels)} {hist.sum}")
+            lines.append(f"{name}_seconds_count{self._labels(**labels)} {hist.count}")
+        lines.append(f"# TYPE {name}_errors_total counter")
+        for key, (count, errors, hist) in table.items():
+            labels = dict(zip(label_names, key if isinstance(key, tuple) else (key,)))
+            lines.append(f"{name}_errors_total{self._labels(**labels)} {errors}")
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition."""
+        lines = []
+        self._render_table(
+            lines, "bot_handler", "Время обработки апдейта хэндлером",
+            self.handlers, ("handler", "state"),
+        )
+        self._render_table(
+            lines, "bot_api", "Время вызова метода Bot API", self.api, ("method",),
+        )
+        lines.append("# TYPE bot_events_total counter")
+        for event, value in self.events.items():
+            lines.append(f"bot_events_total{self._labels(event=event)} {value}")
+        for name, read in self.gauges.items():
+            lines.append(f"# TYPE bot_{name} gauge")
+            lines.append(f"bot_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время и ошибки по хэндлеру и состоянию FSM."""
+
+    def __init__(self, registry: Metrics):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.registry.observe_handler(
+                data["handler"].callback.__name__,
+                data.get("raw_state"),
+                time.perf_counter() - started,
+                error,
+            )
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время исходящих вызовов Bot API по методам."""
+
+    def __init__(self, registry: Metrics):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.registry.observe_api(
+                method.__api_method__, time.perf_counter() - started, error
+            )
+
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(
+        text=metrics.render(),
+        content_type="text/plain",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+class MetricsServer:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_view)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+
+class UpdateLanes(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: апдейты одного пользователя выполняются
+    строго по очереди (своя «полоса»), разные пользователи — параллельно,
+    но не больше max_in_flight хэндлеров одновременно. Если принятых
+    апдейтов больше backlog или полоса пользователя длиннее lane_depth,
+    апдейт не обрабатывается — пользователь получает ответ «занято».
+    """
+
+    BUSY_TEXT = "⏳ Сейчас много заявок, бот не успевает. Повтори, пожалуйста, через минуту."
+    # не чаще одного ответа «занято» пользователю за это число секунд
+    BUSY_NOTICE_INTERVAL = 10.0
+
+    def __init__(self, max_in_flight: int, backlog: int, lane_depth: int):
+        self.backlog = backlog
+        self.lane_depth = lane_depth
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # user_id -> [Lock, сколько апдейтов в полосе]
+        self._lanes = {}
+        self._accepted = 0
+        self._running = 0
+        self._noticed = OrderedDict()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        key = user.id if user else None
+        lane = self._lanes.get(key) if key is not None else None
+        if self._accepted >= self.backlog or (lane is not None and lane[1] >= self.lane_depth):
+            metrics.inc("updates_shed")
+            await self._busy(event, key)
+            return None
+
+        if key is not None and lane is None:
+            lane = self._lanes[key] = [asyncio.Lock(), 0]
+        self._accepted += 1
+        if lane is not None:
+            lane[1] += 1
+        try:
+            if lane is None:
+                return await self._run(handler, event, data)
+            async with lane[0]:
+                return await self._run(handler, event, data)
+        finally:
+            self._accepted -= 1
+            if lane is not None:
+                lane[1] -= 1
+                if not lane[1]:
+                    del self._lanes[key]
+
+    async def _run(self, handler, event, data):
+        async with self._slots:
+            self._running += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self._running -= 1
+
+    async def _busy(self, update: types.Update, key):
+        now = time.monotonic()
+        if key is not None:
+            if now - self._noticed.get(key, float("-inf")) < self.BUSY_NOTICE_INTERVAL:
+                return
+            self._noticed[key] = now
+            self._noticed.move_to_end(key)
+            while len(self._noticed) > 10000:
+                self._noticed.popitem(last=False)
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(self.BUSY_TEXT)
+            elif update.message is not None and update.message.chat.type == ChatType.PRIVATE:
+                await update.message.answer(self.BUSY_TEXT)
+        except TelegramAPIError:
+            pass
+
+    def stats(self) -> dict:
+        return {"accepted": self._accepted, "running": self._running, "lanes": len(self._lanes)}
+
+
+update_lanes = UpdateLanes(MAX_IN_FLIGHT, SHED_BACKLOG, USER_LANE_DEPTH)
+metrics.gauge("updates_accepted", lambda: update_lanes.stats()["accepted"])
+metrics.gauge("updates_running", lambda: update_lanes.stats()["running"])
+
+
+class UserThrottle(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: личные token bucket'ы пользователя на
+    сообщения, кнопки и публикации. Корзина — два числа [токены, время] в
+    OrderedDict по (user_id, вид); корзины, которые успели наполниться до
+    краю, ничем не отличаются от новых и вытесняются, так что память
+    ограничена активными пользователями (и в любом случае max_buckets).
+    О превышении пользователь узнаёт одним сообщением за NOTICE_INTERVAL.
+    """
+
+    NOTICE_TEXT = "🐢 Слишком часто. Подожди немного и повтори."
+    NOTICE_INTERVAL = 30.0
+
+    def __init__(self, limits: dict, max_buckets: int, exempt=frozenset()):
+        # вид -> (токенов в секунду, запас)
+        self.limits = {kind: (per_min / 60, max(1.0, burst)) for kind, (per_min, burst) in limits.items()}
+        self.max_buckets = max_buckets
+        self.exempt = exempt
+        self._buckets = OrderedDict()
+        self._noticed = OrderedDict()
+
+    @staticmethod
+    def kind_of(update: types.Update):
+        if update.message is not None:
+            return "message"
+        if update.callback_query is not None:
+            data = update.callback_query.data or ""
+            if data == PUBLISH_CB or data.startswith(QUICK_PUBLISH_PREFIX):
+                return "publish"
+            return "callback"
+        return None
+
+    def allow(self, user_id: int, kind: str) -> bool:
+        rate, capacity = self.limits[kind]
+        now = time.monotonic()
+        key = (user_id, kind)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+        self._buckets[key] = bucket
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float):
+        # в начале OrderedDict — корзины, к которым дольше всего не обращались
+        while self._buckets:
+            (_, kind), (tokens, updated) = next(iter(self._buckets.items()))
+            rate, capacity = self.limits[kind]
+            if len(self._buckets) <= self.max_buckets and tokens + (now - updated) * rate < capacity:
+                break
+            self._buckets.popitem(last=False)
+
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        kind = self.kind_of(event)
+        if user is None or kind is None or user.id in self.exempt or kind not in self.limits:
+            return await handler(event, data)
+        if self.allow(user.id, kind):
+            return await handler(event, data)
+        metrics.inc("updates_throttled")
+        await self._notice(event, user.id)
+        return None
+
+    async def _notice(self, update: types.Update, user_id: int):
+        now = time.monotonic()
+        if now - self._noticed.get(user_id, float("-inf")) < self.NOTICE_INTERVAL:
+            return
+        self._noticed[user_id] = now
+        self._noticed.move_to_end(user_id)
+        while len(self._noticed) > 10000:
+            self._noticed.popitem(last=False)
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(self.NOTICE_TEXT, show_alert=True)
+            elif update.message is not None and update.message.chat.type == ChatType.PRIVATE:
+                await update.message.answer(self.NOTICE_TEXT)
+        except TelegramAPIError:
+            pass
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets)}
+
+
+user_throttle = UserThrottle(
+    {
+        "message": (THROTTLE_MESSAGES_PER_MIN, THROTTLE_MESSAGE_BURST),
+        "callback": (THROTTLE_CALLBACKS_PER_MIN, THROTTLE_CALLBACK_BURST),
+        "publish": (THROTTLE_PUBLISHES_PER_MIN, THROTTLE_PUBLISH_BURST),
+    },
+    THROTTLE_MAX_BUCKETS,
+    exempt=ADMIN_IDS,
+)
+metrics.gauge("throttle_buckets", lambda: user_throttle.stats()["buckets"])
+
+
+# ==========================
+# ПОВТОРНЫЕ ДОСТАВКИ
+# ==========================
+
+class TTLCache:
+    """Словарь с LRU-вытеснением: не больше max_size ключей, каждый живёт ttl секунд."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (истекает в, значение)
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return item[1]
+
+    def put(self, key, value=True):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        self._items.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class UpdateDedup(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: апдейт с уже виденным update_id (повтор
+    вебхука, перезапуск polling) пропускается без обработки.
+    """
+
+    def __init__(self, seen: TTLCache):
+        self.seen = seen
+
+    async def __call__(self, handler, event: types.Update, data):
+        if event.update_id in self.seen:
+            metrics.inc("updates_duplicate")
+            return None
+        self.seen.put(event.update_id)
+        return await handler(event, data)
+
+
+update_dedup = UpdateDedup(TTLCache(DEDUP_CACHE_SIZE, UPDATE_DEDUP_TTL))
+
+
+class PublishMarks:
+    """
+    Отметки «уже опубликовано»: ключ (заявка из диалога или inline-сообщение)
+    -> номер заявки. Свежие отметки — в TTLCache, все — в таблице publish_marks,
+    поэтому повторное нажатие после перезапуска тоже ничего не отправит.
+    """
+
+    def __init__(self, database: Database, cache: TTLCache):
+        self.db = database
+        self.cache = cache
+        self._pruned_at = 0.0
+        self._ready = False
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS publish_marks (
+                key TEXT PRIMARY KEY,
+                request_id INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """
+        )
+
+    async def claim(self, key: str, request_id: int):
+        """
+        Ставит отметку и возвращает None; если ключ уже отмечен — номер
+        заявки, опубликованной по нему раньше (тогда публиковать не нужно).
+        """
+        existing = self.cache.get(key)
+        if existing is not None:
+            return existing
+        # в памяти отмечаем сразу, до первого await: параллельный тап увидит отметку
+        self.cache.put(key, request_id)
+        try:
+            await self._prepare()
+            now = time.time()
+            if now - self._pruned_at > 3600:
+                self._pruned_at = now
+                await self.db.execute(
+                    "DELETE FROM publish_marks WHERE created_at < ?", (now - self.cache.ttl,)
+                )
+            inserted = await self.db.execute(
+                "INSERT OR IGNORE INTO publish_marks (key, request_id, created_at) VALUES (?, ?, ?)",
+                (key, request_id, now),
+            )
+            if inserted:
+                return None
+            row = await self.db.fetchone("SELECT request_id FROM publish_marks WHERE key = ?", (key,))
+        except Exception:
+            self.cache.pop(key)
+            raise
+        self.cache.put(key, row[0])
+        return row[0]
+
+    async def release(self, key: str):
+        """Публикация по ключу сорвалась — снимаем отметку, чтобы повтор прошёл."""
+        self.cache.pop(key)
+        await self._prepare()
+        await self.db.execute("DELETE FROM publish_marks WHERE key = ?", (key,))
+
+
+publish_marks = PublishMarks(db, TTLCache(DEDUP_CACHE_SIZE, PUBLISH_MARK_TTL))
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Блокирует выдачу токенов (например, на время retry_after)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class PublishQueue:
+    """
+    Очередь публикаций в чаты. Каждое задание сначала сохраняется в SQLite,
+    поэтому очередь переживает рестарт. Для каждого назначения (чат, тема
+    форума) свой воркер, token bucket — на чат (темы делят лимит чата), плюс
+    общий bucket на бота. RetryAfter от Telegram приостанавливает bucket
+    чата на указанное время, задание повторяется.
+
+    С digest_window > 0 накопившиеся задания чата уходят одним сообщением,
+    а новые в течение окна дописываются в открытый дайджест правкой.
+    """
+
+    DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+    def __init__(self, database: Database, rate_per_min: float, burst: int,
+                 global_rate: float, max_attempts: int,
+                 digest_window: float = 0, digest_max_chars: int = 3800):
+        self.db = database
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.digest_window = digest_window
+        self.digest_max_chars = digest_max_chars
+        # (chat_id, thread_id) -> открытый дайджест {"message_id", "text", "opened"}
+        self._digests = {}
+        # request_id -> {"author", "text", "pending", "failed"}: итог публикации в несколько чатов
+        self._fanouts = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bot = None
+        # вызываются после успешной отправки: await listener(job, message)
+        self.listeners = []
+        self._buckets = {}
+        self._jobs = {}
+        self._workers = {}
+        self._ready = False
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS publish_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                request_id INTEGER,
+                author_chat_id INTEGER,
+                text TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                shard INTEGER NOT NULL DEFAULT 0,
+                thread_id INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        await self.db.ensure_column("publish_queue", "shard", "INTEGER NOT NULL DEFAULT 0")
+        await self.db.ensure_column("publish_queue", "thread_id", "INTEGER NOT NULL DEFAULT 0")
+        # каждый шард отправляет только свои задания
+        rows = await self.db.fetchall(
+            "SELECT id, chat_id, thread_id, request_id, author_chat_id, text, attempts "
+            "FROM publish_queue WHERE shard % ? = ? ORDER BY id",
+            (SHARDS, SHARD_INDEX),
+        )
+        for row in rows:
+            job = dict(zip(("id", "chat_id", "thread_id", "request_id", "author_chat_id", "text", "attempts"), row))
+            self._jobs.setdefault((job["chat_id"], job["thread_id"]), deque()).append(job)
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        await self._prepare()
+        for key in list(self._jobs):
+            self._wake(key)
+
+    async def enqueue(self, chat_id: int, text: str, request_id: int, author_chat_id: int,
+                      thread_id: int = 0) -> int:
+        """Ставит публикацию в очередь и возвращает позицию в очереди назначения."""
+        positions = await self.enqueue_many([(chat_id, thread_id)], text, request_id, author_chat_id)
+        return positions[0]
+
+    async def enqueue_many(self, destinations: list, text: str, request_id: int, author_chat_id: int) -> list:
+        """
+        Одна заявка (один и тот же текст) в несколько назначений (chat_id, thread_id).
+        Все назначения отправляются параллельно своими воркерами; если какие-то
+        не удались, автор получает один общий отчёт. Возвращает позиции в очередях.
+        """
+        await self._prepare()
+        job_ids = await self.db.run(self._insert, destinations, request_id, author_chat_id, text)
+        if author_chat_id and len(destinations) > 1:
+            self._fanouts[request_id] = {
+                "author": author_chat_id,
+                "text": text,
+                "pending": len(destinations),
+                "failed": [],
+            }
+        positions = []
+        for job_id, (chat_id, thread_id) in zip(job_ids, destinations):
+            jobs = self._jobs.setdefault((chat_id, thread_id), deque())
+            jobs.append({
+                "id": job_id,
+                "chat_id": chat_id,
+                "thread_id": thread_id,
+                "request_id": request_id,
+                "author_chat_id": author_chat_id,
+                "text": text,
+                "attempts": 0,
+            })
+            positions.append(len(jobs))
+            self._wake((chat_id, thread_id))
+        return positions
+
+    @staticmethod
+    def _insert(conn, destinations, request_id, author_chat_id, text) -> list:
+        now = time.time()
+        with conn:
+            return [
+                conn.execute(
+                    "INSERT INTO publish_queue "
+                    "(chat_id, thread_id, request_id, author_chat_id, text, created_at, shard) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (chat_id, thread_id, request_id, author_chat_id, text, now, SHARD_INDEX),
+                ).lastrowid
+                for chat_id, thread_id in destinations
+            ]
+
+    def pending(self, chat_id: int, thread_id: int = 0) -> int:
+        return len(self._jobs.get((chat_id, thread_id), ()))
+
+    def bucket(self, chat_id: int) -> TokenBucket:
+        """Token bucket чата — общий для публикаций и прочих сообщений бота в этот чат."""
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _wake(self, key: tuple):
+        if self.bot is None:
+            return
+        worker = self._workers.get(key)
+        if worker is None or worker.done():
+            self._workers[key] = asyncio.create_task(self._worker(key))
+
+    def _open_digest(self, key: tuple):
+        digest = self._digests.get(key)
+        if digest is not None and time.monotonic() - digest["opened"] > self.digest_window:
+            del self._digests[key]
+            return None
+        return digest
+
+    def _batch(self, jobs: deque, digest) -> list:
+        """Задания из головы очереди, которые помещаются в одно сообщение."""
+        size = len(digest["text"]) if digest else -len(self.DIGEST_SEPARATOR)
+        batch = []
+        for job in jobs:
+            size += len(self.DIGEST_SEPARATOR) + len(job["text"])
+            if size > self.digest_max_chars and (batch or digest):
+                break
+            batch.append(job)
+        return batch
+
+    def note_edit(self, chat_id: int, message_id: int, text: str):
+        """Сообщение отредактировано снаружи — дописывать в дайджест дальше от нового текста."""
+        for (digest_chat_id, _), digest in self._digests.items():
+            if digest_chat_id == chat_id and digest["message_id"] == message_id:
+                digest["text"] = text
+
+    async def _worker(self, key: tuple):
+        chat_id, thread_id = key
+        jobs = self._jobs[key]
+        bucket = self.bucket(chat_id)
+        solo = False
+        while jobs:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            digest = None
+            batch = [jobs[0]]
+            if self.digest_window and not solo:
+                digest = self._open_digest(key)
+                batch = self._batch(jobs, digest)
+                if not batch:
+                    # в открытый дайджест не влезает — начинаем новый
+                    self._digests.pop(key, None)
+                    digest = None
+                    batch = self._batch(jobs, None)
+            text = self.DIGEST_SEPARATOR.join(job["text"] for job in batch)
+            try:
+                if digest is not None:
+                    text = digest["text"] + self.DIGEST_SEPARATOR + text
+                    message = await self.bot.edit_message_text(
+                        text=text,
+                        chat_id=chat_id,
+                        message_id=digest["message_id"],
+                        parse_mode=ParseMode.HTML,
+                    )
+                else:
+                    message = await self.bot.send_message(
+                        chat_id=chat_id,
+                        message_thread_id=thread_id or None,
+                        text=text,
+                        parse_mode=ParseMode.HTML,
+                    )
+            except TelegramRetryAfter as e:
+                metrics.inc("publish_retry_after")
+                bucket.pause(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError):
+                metrics.inc("publish_retry")
+                job = batch[0]
+                job["attempts"] += 1
+                if job["attempts"] < self.max_attempts:
+                    await self.db.execute(
+                        "UPDATE publish_queue SET attempts = ? WHERE id = ?",
+                        (job["attempts"], job["id"]),
+                    )
+                    bucket.pause(min(60, 2 ** job["attempts"]))
+                    continue
+                for job in batch:
+                    await self._fail(job)
+            except TelegramAPIError:
+                if digest is not None:
+                    # дайджест удалили или его нельзя править — отправим новым сообщением
+                    self._digests.pop(key, None)
+                    continue
+                if len(batch) > 1:
+                    # одна заявка портит всю пачку — дальше по одной, чтобы найти её
+                    solo = True
+                    continue
+                # BadRequest/Forbidden: повтор не поможет
+                await self._fail(batch[0])
+            else:
+                solo = False
+                if self.digest_window:
+                    if digest is None:
+                        self._digests[key] = {
+                            "message_id": message.message_id,
+                            "text": text,
+                            "opened": time.monotonic(),
+                        }
+                    else:
+                        digest["text"] = text
+                        metrics.inc("publish_digest_appended", len(batch))
+                metrics.inc("publish_sent", len(batch))
+                for job in batch:
+                    for listener in self.listeners:
+                        try:
+                            await listener(job, message)
+                        except Exception:
+                            metrics.inc("publish_listener_failed")
+                    await self._settle(job, failed=False)
+            for _ in batch:
+                jobs.popleft()
+            await self.db.executemany(
+                "DELETE FROM publish_queue WHERE id = ?", [(job["id"],) for job in batch]
+            )
+
+    async def _fail(self, job: dict):
+        metrics.inc("publish_failed")
+        await self._settle(job, failed=True)
+
+    async def _settle(self, job: dict, failed: bool):
+        """Задание отправлено или провалено; по публикации в несколько чатов — общий итог."""
+        fanout = self._fanouts.get(job["request_id"]) if job["author_chat_id"] else None
+        if fanout is None:
+            if failed and job["author_chat_id"]:
+                await self._report(job["author_chat_id"], job["request_id"], job["text"], None)
+            return
+        fanout["pending"] -= 1
+        if failed:
+            fanout["failed"].append((job["chat_id"], job.get("thread_id", 0)))
+        if fanout["pending"] > 0:
+            return
+        del self._fanouts[job["request_id"]]
+        if fanout["failed"]:
+            metrics.inc("publish_partial_failed")
+            await self._report(fanout["author"], job["request_id"], fanout["text"], fanout["failed"])
+
+    async def _report(self, author_chat_id: int, request_id: int, text: str, failed):
+        if failed is None:
+            note = (
+                f"⚠️ Не удалось отправить заявку №{request_id} в целевой чат. "
+                "Проверь, что бот добавлен в этот чат и имеет право писать сообщения."
+            )
+        else:
+            where = ", ".join(
+                f"{chat_id} (тема {thread_id})" if thread_id else str(chat_id) for chat_id, thread_id in failed
+            )
+            note = (
+                f"⚠️ Заявка №{request_id} опубликована не во все чаты. Не удалось отправить в: {where}. "
+                "Проверь, что бот добавлен в эти чаты и имеет право писать сообщения."
+            )
+        try:
+            await self.bot.send_message(author_chat_id, note)
+            await self.bot.send_message(author_chat_id, text, parse_mode=ParseMode.HTML)
+        except TelegramAPIError:
+            pass
+
+    async def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+        self._workers.clear()
+
+
+# лимиты Telegram общие на бота, поэтому шарды делят их поровну
+publish_queue = PublishQueue(
+    db,
+    PUBLISH_RATE_PER_MIN / SHARDS,
+    max(1, PUBLISH_BURST // SHARDS),
+    PUBLISH_GLOBAL_RATE / SHARDS,
+    PUBLISH_MAX_ATTEMPTS,
+    DIGEST_WINDOW,
+    DIGEST_MAX_CHARS,
+)
+
+
+ROUTE_CONDITIONS = ("direction", "exchange", "bank")
+
+
+class RoutingTable:
+    """
+    Куда публиковать заявку: маршруты (chat_id, thread_id) с условиями на
+    поля заявки (direction, exchange, bank). Маршрут без условий подходит всем.
+    Биржи сравниваются по EXCHANGE_COMPAT, как при поиске встречных: заявка
+    «Bybit/HTX» подходит и маршруту Bybit, и маршруту HTX. В один чат можно
+    публиковать в несколько тем; одна и та же тема получает заявку один раз.
+    """
+
+    def __init__(self, routes: list):
+        # [(chat_id, thread_id, {поле: допустимые значения})]
+        self.routes = []
+        for route in routes:
+            conditions = {}
+            for name in ROUTE_CONDITIONS:
+                value = route.get(name)
+                if value is not None:
+                    conditions[name] = frozenset([value] if isinstance(value, str) else value)
+            self.routes.append((int(route["chat_id"]), int(route.get("thread_id") or 0), conditions))
+
+    @classmethod
+    def load(cls, path: str, default_chat_id: int) -> "RoutingTable":
+        if path:
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        return cls([{"chat_id": default_chat_id}] if default_chat_id else [])
+
+    @staticmethod
+    def _accepts(record: dict, name: str, values: frozenset) -> bool:
+        value = record.get(name)
+        if name == "exchange":
+            return not values.isdisjoint(EXCHANGE_COMPAT.get(value, (value,)))
+        return value in values
+
+    def destinations(self, record: dict) -> list:
+        result = []
+        for chat_id, thread_id, conditions in self.routes:
+            if (chat_id, thread_id) in result:
+                continue
+            if all(self._accepts(record, name, values) for name, values in conditions.items()):
+                result.append((chat_id, thread_id))
+        return result
+
+
+routes = RoutingTable.load(ROUTES_FILE, TARGET_CHAT_ID)
+
+
+REQUEST_FIELDS = (
+    "request_id",
+    "author_id",
+    "author",
+    "direction",
+    "amount",
+    "rate",
+    "rate_value",
+    "bank",
+    "traffic",
+    "exchange",
+    "conditions",
+    "contact",
+    "amount_ranges",
+    "created_at",
+)
+
+
+def request_record(data: dict, author_id: int) -> dict:
+    """Структурированная заявка из данных FSM — то, что уходит в архив."""
+    record = {name: data.get(name) for name in REQUEST_FIELDS}
+    record["author_id"] = author_id
+    record["created_at"] = time.time()
+    return record
+
+
+class RequestArchive:
+    """
+    Архив опубликованных заявок в SQLite. Основные поля лежат в колонках
+    с индексами, вся заявка целиком — в payload (JSON).
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._ready = False
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                request_id INTEGER PRIMARY KEY,
+                author_id INTEGER NOT NULL,
+                direction TEXT,
+                exchange TEXT,
+                bank TEXT,
+                status TEXT NOT NULL DEFAULT 'open',
+                day TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                payload TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS requests_author ON requests (author_id, request_id);
+            CREATE INDEX IF NOT EXISTS requests_direction ON requests (direction, request_id);
+            CREATE INDEX IF NOT EXISTS requests_exchange ON requests (exchange, request_id);
+            CREATE INDEX IF NOT EXISTS requests_day ON requests (day);
+            """
+        )
+        # counted = 1: заявка уже учтена в таблице stats (см. StatsAggregates)
+        await self.db.ensure_column("requests", "counted", "INTEGER NOT NULL DEFAULT 0")
+        await self.db.execute(
+            "CREATE INDEX IF NOT EXISTS requests_uncounted ON requests (request_id) WHERE counted = 0"
+        )
+
+    # новая заявка — обычный INSERT: повтор номера должен падать, а не затирать архив
+    INSERT_SQL = (
+        "INSERT INTO requests "
+        "(request_id, author_id, direction, exchange, bank, status, day, created_at, payload) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    REPLACE_SQL = INSERT_SQL.replace("INSERT INTO", "INSERT OR REPLACE INTO", 1)
+
+    @staticmethod
+    def _params(record: dict) -> tuple:
+        return (
+            record["request_id"],
+            record["author_id"],
+            record.get("direction"),
+            record.get("exchange"),
+            record.get("bank"),
+            record.get("status", "open"),
+            datetime.fromtimestamp(record["created_at"]).strftime("%Y-%m-%d"),
+            record["created_at"],
+            json.dumps(record, ensure_ascii=False),
+        )
+
+    async def add(self, record: dict):
+        await self._prepare()
+        await self.db.execute(self.INSERT_SQL, self._params(record))
+
+    async def replace(self, record: dict):
+        """Перезаписывает уже существующую заявку (после правки автором)."""
+        await self._prepare()
+        await self.db.execute(self.REPLACE_SQL, self._params(record))
+
+    async def add_many(self, records: list) -> list:
+        """Пишет пачку одной транзакцией; возвращает заявки, чьи номера уже заняты."""
+        await self._prepare()
+
+        def _insert(conn):
+            taken = []
+            with conn:
+                for record in records:
+                    try:
+                        conn.execute(self.INSERT_SQL, self._params(record))
+                    except sqlite3.IntegrityError:
+                        taken.append(record)
+            return taken
+        return await self.db.run(_insert)
+
+    @staticmethod
+    def _row(row) -> dict:
+        record = json.loads(row[1])
+        record["status"] = row[0]
+        return record
+
+    async def get(self, request_id: int):
+        await self._prepare()
+        row = await self.db.fetchone(
+            "SELECT status, payload FROM requests WHERE request_id = ?", (request_id,)
+        )
+        return self._row(row) if row else None
+
+    async def iter_open(self, chunk: int = 1000):
+        """Все открытые заявки, порциями по chunk, чтобы не держать выборку целиком."""
+        await self._prepare()
+        last_id = 0
+        while True:
+            rows = await self.db.fetchall(
+                "SELECT status, payload, request_id FROM requests "
+                "WHERE status = 'open' AND request_id > ? ORDER BY request_id LIMIT ?",
+                (last_id, chunk),
+            )
+            for row in rows:
+                yield self._row(row)
+            if len(rows) < chunk:
+                return
+            last_id = rows[-1][2]
+
+    async def delete(self, request_id: int):
+        await self._prepare()
+        await self.db.execute("DELETE FROM requests WHERE request_id = ?", (request_id,))
+
+    async def set_status(self, request_id: int, status: str):
+        await self._prepare()
+        await self.db.execute(
+            "UPDATE requests SET status = ? WHERE request_id = ?", (status, request_id)
+        )
+
+    async def by_author(self, author_id: int, before_id=None, limit: int = MY_PAGE_SIZE) -> list:
+        """Страница заявок автора, от новых к старым (keyset-пагинация по request_id)."""
+        await self._prepare()
+        if before_id is None:
+            rows = await self.db.fetchall(
+                "SELECT status, payload FROM requests WHERE author_id = ? "
+                "ORDER BY request_id DESC LIMIT ?",
+                (author_id, limit),
+            )
+        else:
+            rows = await self.db.fetchall(
+                "SELECT status, payload FROM requests WHERE author_id = ? AND request_id < ? "
+                "ORDER BY request_id DESC LIMIT ?",
+                (author_id, before_id, limit),
+            )
+        return [self._row(row) for row in rows]
+
+
+archive = RequestArchive(db)
+
+
+# ==========================
+# ПОИСК ВСТРЕЧНЫХ ЗАЯВОК
+# ==========================
+
+class IntervalTree:
+    """
+    Дерево интервалов на декартовом дереве (treap): ключ — (lo, id),
+    в каждом узле хранится максимум hi по поддереву. Вставка и удаление
+    за O(log n), поиск пересечений за O(log n + k).
+    """
+
+    class _Node:
+        __slots__ = ("lo", "hi", "key", "priority", "left", "right", "max_hi")
+
+        def __init__(self, lo, hi, key):
+            self.lo = lo
+            self.hi = hi
+            self.key = key
+            self.priority = random.random()
+            self.left = None
+            self.right = None
+            self.max_hi = hi
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _update(node):
+        node.max_hi = node.hi
+        if node.left is not None and node.left.max_hi > node.max_hi:
+            node.max_hi = node.left.max_hi
+        if node.right is not None and node.right.max_hi > node.max_hi:
+            node.max_hi = node.right.max_hi
+
+    def _split(self, node, pivot, inclusive):
+        # делит на (< pivot, >= pivot) или, если inclusive, на (<= pivot, > pivot)
+        if node is None:
+            return None, None
+        goes_left = (node.lo, node.key) <= pivot if inclusive else (node.lo, node.key) < pivot
+        if goes_left:
+            left, right = self._split(node.right, pivot, inclusive)
+            node.right = left
+            self._update(node)
+            return node, right
+        left, right = self._split(node.left, pivot, inclusive)
+        node.left = right
+        self._update(node)
+        return left, node
+
+    def _merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+
+    def add(self, lo, hi, key):
+        left, right = self._split(self.root, (lo, key), False)
+        self.root = self._merge(self._merge(left, self._Node(lo, hi, key)), right)
+        self.size += 1
+
+    def remove(self, lo, key) -> bool:
+        left, rest = self._split(self.root, (lo, key), False)
+        middle, right = self._split(rest, (lo, key), True)
+        self.root = self._merge(left, right)
+        if middle is not None:
+            self.size -= 1
+            return True
+        return False
+
+    def overlapping(self, lo, hi):
+        """Ключи интервалов, пересекающих [lo, hi], в порядке возрастания lo."""
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            # спускаемся влево, пропуская поддеревья, где все интервалы левее lo
+            while node is not None and node.max_hi >= lo:
+                stack.append(node)
+                node = node.left
+            if not stack:
+                return
+            node = stack.pop()
+            if node.lo > hi:
+                # дальше только интервалы, которые начинаются правее hi
+                return
+            if node.hi >= lo:
+                yield node.key
+            node = node.right
+
+
+ANY_BANK = "Любой банк (СБП)"
+EXCHANGE_COMPAT = {
+    "Bybit": ("Bybit", "Bybit/HTX"),
+    "HTX": ("HTX", "Bybit/HTX"),
+    "Bybit/HTX": ("Bybit", "HTX", "Bybit/HTX"),
+}
+
+
+def opposite_direction(direction):
+    return DIRECTION_SEND if direction == DIRECTION_RECEIVE else DIRECTION_RECEIVE
+
+
+class MatchIndex:
+    """
+    Открытые заявки, разложенные по (направление, биржа) -> банк -> дерево
+    интервалов сумм. Поиск встречных обходит только совместимые разделы.
+    """
+
+    def __init__(self):
+        self._partitions = {}
+        # request_id -> (record, [(partition_key, bank, lo), ...])
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _ranges(record: dict) -> list:
+        return record.get("amount_ranges") or parse_amounts(record.get("amount") or "")
+
+    def add(self, record: dict):
+        request_id = record["request_id"]
+        self.remove(request_id)
+        ranges = self._ranges(record)
+        if not ranges:
+            return
+        part_key = (record.get("direction"), record.get("exchange"))
+        bank = record.get("bank")
+        banks = self._partitions.setdefault(part_key, {})
+        tree = banks.get(bank)
+        if tree is None:
+            tree = banks[bank] = IntervalTree()
+        entries = []
+        for lo, hi in ranges:
+            tree.add(lo, hi, request_id)
+            entries.append((part_key, bank, lo))
+        self._records[request_id] = (record, entries)
+
+    def remove(self, request_id: int):
+        item = self._records.pop(request_id, None)
+        if item is None:
+            return
+        for part_key, bank, lo in item[1]:
+            banks = self._partitions.get(part_key, {})
+            tree = banks.get(bank)
+            if tree is None:
+                continue
+            tree.remove(lo, request_id)
+            if not tree:
+                del banks[bank]
+        if not self._partitions.get(item[1][0][0]):
+            self._partitions.pop(item[1][0][0], None)
+
+    def get(self, request_id: int):
+        item = self._records.get(request_id)
+        return item[0] if item else None
+
+    def find(self, record: dict, limit: int = MATCH_LIMIT) -> list:
+        """Встречные заявки с пересекающимися суммами, лучшие — первыми."""
+        ranges = self._ranges(record)
+        direction = opposite_direction(record.get("direction"))
+        exchange = record.get("exchange")
+        bank = record.get("bank")
+        # сколько суммы пересекается с заявкой: request_id -> overlap
+        overlap = {}
+        for other_exchange in EXCHANGE_COMPAT.get(exchange, (exchange,)):
+            banks = self._partitions.get((direction, other_exchange))
+            if not banks:
+                continue
+            if bank == ANY_BANK:
+                trees = banks.values()
+            else:
+                trees = [banks[b] for b in (bank, ANY_BANK) if b in banks]
+            for tree in trees:
+                for lo, hi in ranges:
+                    for n, key in enumerate(tree.overlapping(lo, hi)):
+                        if n >= MATCH_SCAN_LIMIT:
+                            break
+                        other = self._records[key][0]
+                        if other.get("author_id") == record.get("author_id"):
+                            continue
+                        size = max(
+                            min(hi, o_hi) - max(lo, o_lo)
+                            for o_lo, o_hi in self._ranges(other)
+                            if o_lo <= hi and o_hi >= lo
+                        )
+                        overlap[key] = max(overlap.get(key, -1), size)
+        best = sorted(overlap, key=lambda k: (-overlap[k], -k))[:limit]
+        return [self._records[k][0] for k in best]
+
+
+match_index = MatchIndex()
+
+
+# ==========================
+# ПОИСК ПО ЗАЯВКАМ (/find)
+# ==========================
+
+SEARCH_FIELDS = ("direction", "bank", "traffic", "exchange", "conditions", "contact")
+# слова индексируются целиком и всеми префиксами от этой длины: «сбер» найдёт «Сбербанк»
+SEARCH_MIN_PREFIX = 3
+SEARCH_MAX_PREFIX = 20
+SEARCH_WORD_RE = re.compile(r"\w+")
+
+
+def search_words(text: str) -> list:
+    return [w for w in SEARCH_WORD_RE.findall(text.lower().replace("ё", "е")) if not w.isdigit()]
+
+
+class SearchIndex:
+    """
+    Инвертированный индекс открытых заявок: слово или префикс слова ->
+    множество request_id. Запрос из нескольких слов — пересечение множеств,
+    начиная с самого короткого. Для фильтров по сумме — дерево интервалов,
+    по курсу — отсортированный список (курс, request_id).
+    """
+
+    def __init__(self):
+        self._postings = {}
+        # request_id -> (record, ключи в _postings, суммы, курс)
+        self._records = {}
+        # request_id -> (меньшая граница сумм, большая граница, одна ли сумма) — быстрый фильтр
+        self._spans = {}
+        self._amounts = IntervalTree()
+        self._rates = []
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _keys(record: dict) -> set:
+        text = " ".join(str(record.get(name) or "") for name in SEARCH_FIELDS)
+        if record.get("direction") in DIRECTIONS:
+            text += " " + direction_label(record["direction"])
+        keys = set()
+        for word in search_words(text):
+            keys.add(word)
+            for end in range(SEARCH_MIN_PREFIX, min(len(word), SEARCH_MAX_PREFIX)):
+                keys.add(word[:end])
+        return keys
+
+    @staticmethod
+    def _rate(record: dict):
+        try:
+            return float(record.get("rate_value"))
+        except (TypeError, ValueError):
+            return None
+
+    def add(self, record: dict):
+        request_id = record["request_id"]
+        self.remove(request_id)
+        keys = self._keys(record)
+        for key in keys:
+            self._postings.setdefault(key, set()).add(request_id)
+        ranges = MatchIndex._ranges(record)
+        for lo, hi in ranges:
+            self._amounts.add(lo, hi, request_id)
+        rate = self._rate(record)
+        if rate is not None:
+            bisect.insort(self._rates, (rate, request_id))
+        self._records[request_id] = (record, keys, ranges, rate)
+        if ranges:
+            self._spans[request_id] = (min(lo for lo, _ in ranges), max(hi for _, hi in ranges), len(ranges) == 1)
+
+    def remove(self, request_id: int):
+        item = self._records.pop(request_id, None)
+        if item is None:
+            return
+        _, keys, ranges, rate = item
+        self._spans.pop(request_id, None)
+        for key in keys:
+            ids = self._postings.get(key)
+            if ids is not None:
+                ids.discard(request_id)
+                if not ids:
+                    del self._postings[key]
+        for lo, _ in ranges:
+            self._amounts.remove(lo, request_id)
+        if rate is not None:
+            pos = bisect.bisect_left(self._rates, (rate, request_id))
+            if pos < len(self._rates) and self._rates[pos] == (rate, request_id):
+                del self._rates[pos]
+
+    def search(self, words: list, amount=None, rate_lo=None, rate_hi=None, limit: int = FIND_LIMIT):
+        """
+        Заявки, где есть все слова (или их начала), сумма пересекается с
+        amount = [lo, hi], а курс в [rate_lo, rate_hi]. Возвращает
+        (сколько всего найдено, до limit самых свежих записей).
+        """
+        sets = []
+        for word in set(words):
+            ids = self._postings.get(word)
+            if not ids:
+                return 0, []
+            sets.append(ids)
+        sets.sort(key=len)
+        by_rate = rate_lo is not None or rate_hi is not None
+        if by_rate:
+            start = 0 if rate_lo is None else bisect.bisect_left(self._rates, (rate_lo, float("-inf")))
+            end = (
+                len(self._rates) if rate_hi is None
+                else bisect.bisect_right(self._rates, (rate_hi, float("inf")))
+            )
+        # начинаем с самого короткого источника, остальные пересекаем (в C, через set)
+        if by_rate and (not sets or end - start < len(sets[0])):
+            candidates = {rid for _, rid in self._rates[start:end]}
+            if sets:
+                candidates = candidates.intersection(*sets)
+            rate_lo = rate_hi = None
+        elif sets:
+            candidates = sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]
+        elif amount is not None:
+            candidates = set(self._amounts.overlapping(amount[0], amount[1]))
+            amount = None
+        else:
+            return 0, []
+        records, spans = self._records, self._spans
+        found = candidates
+        if amount is not None:
+            a_lo, a_hi = amount
+            found = [
+                rid for rid in found
+                if rid in spans and spans[rid][0] <= a_hi and spans[rid][1] >= a_lo and (
+                    spans[rid][2] or any(lo <= a_hi and hi >= a_lo for lo, hi in records[rid][2])
+                )
+            ]
+        if rate_lo is not None:
+            found = [rid for rid in found if records[rid][3] is not None and records[rid][3] >= rate_lo]
+        if rate_hi is not None:
+            found = [rid for rid in found if records[rid][3] is not None and records[rid][3] <= rate_hi]
+        best = heapq.nlargest(limit, found)
+        return len(found), [self._records[rid][0] for rid in best]
+
+
+search_index = SearchIndex()
+
+
+# ==========================
+# СТАКАН КУРСОВ И ТАБЛО
+# ==========================
+
+class OrderBook:
+    """Заявки одной биржи и одного направления, отсортированные по курсу."""
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, rate: Decimal, request_id: int):
+        bisect.insort(self._entries, (rate, request_id))
+
+    def remove(self, rate: Decimal, request_id: int):
+        i = bisect.bisect_left(self._entries, (rate, request_id))
+        if i < len(self._entries) and self._entries[i] == (rate, request_id):
+            del self._entries[i]
+
+    def lowest(self):
+        return self._entries[0] if self._entries else None
+
+    def highest(self):
+        return self._entries[-1] if self._entries else None
+
+
+class OrderBooks:
+    """
+    Стаканы по (биржа, направление). «Отправить RUB» — покупатели USDT,
+    лучший для них курс — наибольший; «Принять RUB» — продавцы, лучший — наименьший.
+    Заявка на «Bybit/HTX» попадает в стаканы обеих бирж.
+    """
+
+    def __init__(self):
+        self._books = {}
+        # request_id -> [(book_key, rate), ...]
+        self._entries = {}
+
+    def add(self, record: dict):
+        request_id = record["request_id"]
+        self.remove(request_id)
+        rate = parse_rate(record.get("rate_value") or record.get("rate") or "")
+        if rate is None:
+            return
+        entries = []
+        for exchange in (record.get("exchange") or "").split("/"):
+            key = (exchange, record.get("direction"))
+            book = self._books.get(key)
+            if book is None:
+                book = self._books[key] = OrderBook()
+            book.add(rate, request_id)
+            entries.append((key, rate))
+        self._entries[request_id] = entries
+
+    def remove(self, request_id: int):
+        for key, rate in self._entries.pop(request_id, ()):
+            self._books[key].remove(rate, request_id)
+
+    def best_bid(self, exchange: str):
+        book = self._books.get((exchange, DIRECTION_SEND))
+        return book.highest() if book else None
+
+    def best_ask(self, exchange: str):
+        book = self._books.get((exchange, DIRECTION_RECEIVE))
+        return book.lowest() if book else None
+
+    def depth(self, exchange: str, direction: str) -> int:
+        book = self._books.get((exchange, direction))
+        return len(book) if book else 0
+
+    def exchanges(self) -> list:
+        return sorted({exchange for exchange, _ in self._books})
+
+
+order_books = OrderBooks()
+
+
+def render_board(books: OrderBooks) -> str:
+    lines = ["📊 <b>Лучшие курсы по открытым заявкам</b>"]
+    for exchange in books.exchanges():
+        bid = books.best_bid(exchange)
+        ask = books.best_ask(exchange)
+        if bid is None and ask is None:
+            continue
+        lines.append(f"\n<b>{exchange}</b>")
+        if bid is not None:
+            lines.append(
+                f"🟢 Отправят RUB: <b>{bid[0]}</b> (№{bid[1]}), "
+                f"заявок: {books.depth(exchange, DIRECTION_SEND)}"
+            )
+        if ask is not None:
+            lines.append(
+                f"🔴 Примут RUB: <b>{ask[0]}</b> (№{ask[1]}), "
+                f"заявок: {books.depth(exchange, DIRECTION_RECEIVE)}"
+            )
+    if len(lines) == 1:
+        lines.append("\nОткрытых заявок пока нет.")
+    lines.append(f"\nОбновлено: {datetime.now().strftime('%d.%m %H:%M')}")
+    return "\n".join(lines)
+
+
+class Board:
+    """
+    Закреплённое сообщение-табло в целевом чате. Изменения копятся и
+    применяются одним edit_message_text не чаще раза в interval секунд.
+    """
+
+    META_KEY = "board_message_id"
+
+    def __init__(self, database: Database, books: OrderBooks, interval: float):
+        self.db = database
+        self.books = books
+        self.interval = interval
+        self.bot = None
+        self.chat_id = 0
+        self.message_id = None
+        self._last_text = None
+        self._last_edit = 0.0
+        self._dirty = False
+        self._task = None
+
+    async def start(self, bot: Bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = await self.db.get_meta(self.META_KEY)
+        self.touch()
+
+    def touch(self):
+        """Отметить, что стакан изменился; само редактирование — отложенно."""
+        if self.bot is None:
+            return
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._dirty = False
+            try:
+                await self.flush()
+            except TelegramAPIError:
+                pass
+            self._last_edit = time.monotonic()
+
+    async def flush(self):
+        text = render_board(self.books)
+        if text == self._last_text:
+            return
+        await publish_queue.bucket(self.chat_id).acquire()
+        if self.message_id is not None:
+            try:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    parse_mode=ParseMode.HTML,
+                )
+                self._last_text = text
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._last_text = text
+                    return
+                # сообщение удалили — создадим новое
+        message = await self.bot.send_message(self.chat_id, text, parse_mode=ParseMode.HTML)
+        self.message_id = message.message_id
+        self._last_text = text
+        await self.db.set_meta(self.META_KEY, self.message_id)
+        try:
+            await self.bot.pin_chat_message(
+                self.chat_id, self.message_id, disable_notification=True
+            )
+        except TelegramAPIError:
+            pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+board = Board(db, order_books, BOARD_INTERVAL)
+
+
+# в режиме sharded — входящие очереди остальных шардов: индексы открытых
+# заявок нужны каждому шарду целиком, поэтому изменения рассылаются всем
+shard_peers = []
+# все входящие очереди по номеру шарда — чтобы отдать что-то шарду-владельцу пользователя
+shard_inboxes = []
+
+
+def open_request(record: dict, broadcast: bool = True):
+    """Заявка опубликована — добавляем её во все индексы открытых заявок."""
+    match_index.add(record)
+    search_index.add(record)
+    order_books.add(record)
+    board.touch()
+    if broadcast:
+        for peer in shard_peers:
+            peer.put(("open", record))
+
+
+def close_request(request_id: int, broadcast: bool = True):
+    """Заявка закрыта или истекла — убираем из индексов."""
+    match_index.remove(request_id)
+    search_index.remove(request_id)
+    order_books.remove(request_id)
+    board.touch()
+    if broadcast:
+        for peer in shard_peers:
+            peer.put(("close", request_id))
+
+
+async def load_open_requests():
+    # каждый шард сам читает открытые заявки из общего архива — рассылать их не нужно
+    async for record in archive.iter_open():
+        open_request(record, broadcast=False)
+
+
+# ==========================
+# СТАТИСТИКА
+# ==========================
+
+STATS_DIMENSIONS = ("direction", "bank", "exchange", "traffic")
+
+
+class StatsAggregates:
+    """
+    Счётчики опубликованных заявок: (период "d"/"h", начало суток/часа, поле,
+    значение) -> [заявок, сумма]. Публикация запоминает вклад заявки в памяти
+    за O(1), раз в flush_interval накопленное прибавляется к таблице stats —
+    именно прибавляется, чтобы шарды не затирали друг друга. /stats читает
+    только эту таблицу, поэтому отвечает одинаково быстро при любом размере
+    архива.
+
+    Учтённые заявки помечаются в архиве (requests.counted) в той же транзакции,
+    что и прибавка: вклад заявки, уже учтённой пересчётом, при сбросе
+    отбрасывается — на любом шарде.
+    """
+
+    def __init__(self, database: Database, flush_interval: float, hourly_days: int):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.hourly_days = hourly_days
+        self._pending = {}
+        self._pruned_at = 0.0
+        self._task = None
+        self._ready = False
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS stats (
+                period TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                dimension TEXT NOT NULL,
+                value TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                PRIMARY KEY (period, start, dimension, value)
+            );
+            """
+        )
+
+    @staticmethod
+    def buckets(record: dict):
+        """Ключи счётчиков, которые задевает заявка, и её сумма (верхние границы)."""
+        hour = datetime.fromtimestamp(record["created_at"]).replace(minute=0, second=0, microsecond=0)
+        starts = (("d", int(hour.replace(hour=0).timestamp())), ("h", int(hour.timestamp())))
+        values = [("total", "")] + [
+            (name, (record.get(name) or "—").strip()[:64]) for name in STATS_DIMENSIONS
+        ]
+        amount = sum(hi for _, hi in record.get("amount_ranges") or ())
+        return [((period, start) + value, amount) for period, start in starts for value in values], amount
+
+    def record(self, record: dict):
+        self._pending[record["request_id"]] = self.buckets(record)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    UPSERT_SQL = (
+        "INSERT INTO stats (period, start, dimension, value, requests, amount) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (period, start, dimension, value) DO UPDATE SET "
+        "requests = requests + excluded.requests, amount = amount + excluded.amount"
+    )
+
+    @staticmethod
+    def _add(totals: dict, keys: list, count: int = 1):
+        for key, amount in keys:
+            counter = totals.setdefault(key, [0, 0.0])
+            counter[0] += count
+            counter[1] += count * amount
+
+    def _apply(self, conn, pending: dict):
+        totals = {}
+        with conn:
+            for request_id, (keys, _) in pending.items():
+                # заявку уже посчитал пересчёт (или другой сброс) — второй раз не прибавляем
+                marked = conn.execute(
+                    "UPDATE requests SET counted = 1 WHERE request_id = ? AND counted = 0", (request_id,)
+                ).rowcount
+                if marked:
+                    self._add(totals, keys)
+            conn.executemany(self.UPSERT_SQL, [key + tuple(counter) for key, counter in totals.items()])
+
+    async def flush(self):
+        await self._prepare()
+        pending, self._pending = self._pending, {}
+        if pending:
+            await self.db.run(self._apply, pending)
+        now = time.time()
+        if now - self._pruned_at > 3600:
+            self._pruned_at = now
+            await self.db.execute(
+                "DELETE FROM stats WHERE period = 'h' AND start < ?", (now - self.hourly_days * 86400,)
+            )
+
+    @staticmethod
+    def _read_table(conn) -> dict:
+        return {
+            tuple(row[:4]): [row[4], row[5]]
+            for row in conn.execute("SELECT period, start, dimension, value, requests, amount FROM stats")
+        }
+
+    def _scan(self, horizon: float):
+        """
+        Снимок архива для пересчёта. Пока одно соединение держит блокировку
+        записи, второе открывает снимок чтения, а первое помечает все заявки
+        снимка учтёнными и запоминает таблицу stats. Дальше снимок читается
+        без блокировки; всё, что сбросят за это время, — заявки после снимка.
+        """
+        marker = sqlite3.connect(self.db.path, timeout=30, isolation_level=None)
+        reader = sqlite3.connect(self.db.path, isolation_level=None)
+        try:
+            marker.execute("BEGIN IMMEDIATE")
+            try:
+                reader.execute("BEGIN")
+                reader.execute("SELECT 1 FROM requests LIMIT 1").fetchall()
+                marker.execute("UPDATE requests SET counted = 1 WHERE counted = 0")
+                before = self._read_table(marker)
+                token = os.urandom(8).hex()
+                Database._meta_table(marker)
+                marker.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    ("stats_rebuild", json.dumps(token)),
+                )
+                marker.execute("COMMIT")
+            except BaseException:
+                marker.execute("ROLLBACK")
+                raise
+            totals, count = {}, 0
+            for (payload,) in reader.execute("SELECT payload FROM requests"):
+                keys, _ = self.buckets(json.loads(payload))
+                self._add(totals, [(key, amount) for key, amount in keys if key[0] == "d" or key[1] >= horizon])
+                count += 1
+            reader.execute("COMMIT")
+            return totals, before, token, count
+        finally:
+            reader.close()
+            marker.close()
+
+    @classmethod
+    def _replace(cls, conn, totals: dict, before: dict, token: str, horizon: float) -> bool:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'stats_rebuild'").fetchone()
+            if row is None or json.loads(row[0]) != token:
+                # следом начался другой пересчёт, его снимок новее
+                conn.rollback()
+                return False
+            # что сбросили после снимка (любой шард), прибавляется к пересчитанному
+            for key, (requests, amount) in cls._read_table(conn).items():
+                old = before.get(key, (0, 0.0))
+                counter = totals.setdefault(key, [0, 0.0])
+                counter[0] += requests - old[0]
+                counter[1] += amount - old[1]
+            conn.execute("DELETE FROM stats")
+            conn.executemany(
+                "INSERT INTO stats (period, start, dimension, value, requests, amount) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    key + tuple(counter) for key, counter in totals.items()
+                    if counter[0] > 0 and (key[0] == "d" or key[1] >= horizon)
+                ],
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return True
+
+    async def rebuild(self) -> int:
+        """Пересчитывает все счётчики по архиву; возвращает число заявок."""
+        await self._prepare()
+        await archive._prepare()
+        horizon = time.time() - self.hourly_days * 86400
+        # архив читается своими соединениями в отдельном потоке, поток базы не занят;
+        # вклад заявок из снимка, ещё не сброшенный здесь или на других шардах,
+        # отбросит flush — они уже помечены учтёнными
+        totals, before, token, count = await asyncio.to_thread(self._scan, horizon)
+        await self.db.run(self._replace, totals, before, token, horizon)
+        return count
+
+    async def summary(self, since: float) -> dict:
+        """Суммы по полям, по дням и по часам текущих суток начиная с since."""
+        await self.flush()
+        day_start = int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+        rows = await self.db.fetchall(
+            "SELECT dimension, value, SUM(requests), SUM(amount) FROM stats "
+            "WHERE period = 'd' AND start >= ? GROUP BY dimension, value",
+            (since,),
+        )
+        days = await self.db.fetchall(
+            "SELECT start, requests FROM stats WHERE period = 'd' AND dimension = 'total' "
+            "AND start >= ? ORDER BY start",
+            (since,),
+        )
+        hours = await self.db.fetchall(
+            "SELECT start, requests FROM stats WHERE period = 'h' AND dimension = 'total' "
+            "AND start >= ? ORDER BY start",
+            (day_start,),
+        )
+        by_dimension = {}
+        for dimension, value, requests, amount in rows:
+            by_dimension.setdefault(dimension, []).append((value, requests, amount))
+        for values in by_dimension.values():
+            values.sort(key=lambda item: -item[1])
+        return {"dimensions": by_dimension, "days": days, "hours": hours}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._pending:
+            await self.flush()
+
+
+stats = StatsAggregates(db, STATS_FLUSH_INTERVAL, STATS_HOURLY_DAYS)
+
+
+# ==========================
+# ПОДПИСКИ
+# ==========================
+
+class Subscriptions:
+    """
+    Сохранённые поиски: о подходящей новой заявке пользователь узнаёт в личке.
+    Подписки лежат в SQLite, в памяти разложены как в MatchIndex:
+    (направление, биржа) -> банк -> дерево интервалов сумм, где None —
+    «любое значение». Новая заявка проверяется только в совместимых разделах
+    и только против подписок с пересекающейся суммой, а не перебором всех.
+    """
+
+    FIELDS = ("id", "user_id", "direction", "exchange", "bank", "amount_lo", "amount_hi", "rate_lo", "rate_hi")
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._partitions = {}
+        self._subs = {}
+        # user_id -> {id подписки}
+        self._by_user = {}
+        self._ready = False
+
+    def __len__(self):
+        return len(self._subs)
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                direction TEXT,
+                exchange TEXT,
+                bank TEXT,
+                amount_lo REAL NOT NULL,
+                amount_hi REAL NOT NULL,
+                rate_lo REAL,
+                rate_hi REAL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS subscriptions_user ON subscriptions (user_id);
+            """
+        )
+
+    async def load(self):
+        await self._prepare()
+        rows = await self.db.fetchall(f"SELECT {', '.join(self.FIELDS)} FROM subscriptions")
+        for row in rows:
+            self.index(dict(zip(self.FIELDS, row)))
+
+    def index(self, sub: dict):
+        banks = self._partitions.setdefault((sub["direction"], sub["exchange"]), {})
+        tree = banks.get(sub["bank"])
+        if tree is None:
+            tree = banks[sub["bank"]] = IntervalTree()
+        tree.add(sub["amount_lo"], sub["amount_hi"], sub["id"])
+        self._subs[sub["id"]] = sub
+        self._by_user.setdefault(sub["user_id"], set()).add(sub["id"])
+
+    def unindex(self, sub_id: int):
+        sub = self._subs.pop(sub_id, None)
+        if sub is None:
+            return
+        part_key = (sub["direction"], sub["exchange"])
+        banks = self._partitions.get(part_key, {})
+        tree = banks.get(sub["bank"])
+        if tree is not None:
+            tree.remove(sub["amount_lo"], sub_id)
+            if not tree:
+                del banks[sub["bank"]]
+        if not banks:
+            self._partitions.pop(part_key, None)
+        ids = self._by_user.get(sub["user_id"], set())
+        ids.discard(sub_id)
+        if not ids:
+            self._by_user.pop(sub["user_id"], None)
+
+    def by_user(self, user_id: int) -> list:
+        return [self._subs[sub_id] for sub_id in sorted(self._by_user.get(user_id, ()))]
+
+    async def add(self, user_id: int, criteria: dict) -> dict:
+        await self._prepare()
+        sub = dict(criteria, user_id=user_id)
+        sub["id"] = await self.db.run(self._insert, sub)
+        self.index(sub)
+        for peer in shard_peers:
+            peer.put(("subscribe", sub))
+        return sub
+
+    @staticmethod
+    def _insert(conn, sub: dict) -> int:
+        with conn:
+            return conn.execute(
+                "INSERT INTO subscriptions "
+                "(user_id, direction, exchange, bank, amount_lo, amount_hi, rate_lo, rate_hi, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                tuple(sub[name] for name in Subscriptions.FIELDS[1:]) + (time.time(),),
+            ).lastrowid
+
+    async def remove(self, user_id: int, sub_ids) -> int:
+        """Удаляет подписки пользователя по id; возвращает, сколько удалено."""
+        sub_ids = [sub_id for sub_id in sub_ids if sub_id in self._by_user.get(user_id, ())]
+        if not sub_ids:
+            return 0
+        await self._prepare()
+        await self.db.executemany("DELETE FROM subscriptions WHERE id = ?", [(sub_id,) for sub_id in sub_ids])
+        for sub_id in sub_ids:
+            self.unindex(sub_id)
+            for peer in shard_peers:
+                peer.put(("unsubscribe", sub_id))
+        return len(sub_ids)
+
+    def match(self, record: dict) -> list:
+        """Подписки, под которые подходит заявка, — не больше одной на пользователя."""
+        ranges = MatchIndex._ranges(record)
+        rate = SearchIndex._rate(record)
+        exchange = record.get("exchange")
+        bank = record.get("bank")
+        found = {}
+        for direction in (record.get("direction"), None):
+            for other_exchange in set(EXCHANGE_COMPAT.get(exchange, (exchange,))) | {None}:
+                banks = self._partitions.get((direction, other_exchange))
+                if not banks:
+                    continue
+                if bank == ANY_BANK:
+                    trees = banks.values()
+                else:
+                    # подписка на «любой банк (СБП)» подходит заявке с любым банком, как в MatchIndex.find
+                    trees = [banks[b] for b in dict.fromkeys((bank, ANY_BANK, None)) if b in banks]
+                for tree in trees:
+                    for lo, hi in ranges:
+                        for sub_id in tree.overlapping(lo, hi):
+                            sub = self._subs[sub_id]
+                            if sub["user_id"] in found or sub["user_id"] == record.get("author_id"):
+                                continue
+                            if sub["rate_lo"] is not None and (rate is None or rate < sub["rate_lo"]):
+                                continue
+                            if sub["rate_hi"] is not None and (rate is None or rate > sub["rate_hi"]):
+                                continue
+                            found[sub["user_id"]] = sub
+        return list(found.values())
+
+
+subscriptions = Subscriptions(db)
+
+
+class DirectSender:
+    """
+    Личные уведомления: одна очередь в памяти и один воркер с token bucket
+    на все уведомления (плюс общий bucket бота из очереди публикаций).
+    Рассылка на тысячи подписчиков только складывает сообщения в очередь,
+    а отправка идёт в темпе лимитов Telegram. Очередь ограничена max_queue:
+    при переполнении теряются самые старые уведомления.
+    """
+
+    def __init__(self, rate: float, max_queue: int):
+        self.bucket = TokenBucket(rate, rate)
+        self.max_queue = max_queue
+        self.bot = None
+        self._queue = deque()
+        self._task = None
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._wake()
+
+    def send(self, chat_id: int, text: str, sub_id: int = None):
+        # клавиатуру с отпиской собирает воркер: он всё равно ждёт лимита,
+        # а рассылка на тысячи подписчиков не тратит время на объекты кнопок
+        self._queue.append((chat_id, text, sub_id))
+        while len(self._queue) > self.max_queue:
+            self._queue.popleft()
+            metrics.inc("notify_dropped")
+        self._wake()
+
+    def _wake(self):
+        if self.bot is None or not self._queue:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._worker())
+
+    async def _worker(self):
+        while self._queue:
+            await self.bucket.acquire()
+            await publish_queue.global_bucket.acquire()
+            item = self._queue[0]
+            chat_id, text, sub_id = item
+            try:
+                await self.bot.send_message(
+                    chat_id, text, parse_mode=ParseMode.HTML,
+                    reply_markup=None if sub_id is None else notification_kb(sub_id),
+                )
+                metrics.inc("notify_sent")
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                # бот заблокирован — подписки этого пользователя больше не нужны
+                metrics.inc("notify_forbidden")
+                await subscriptions.remove(chat_id, [sub["id"] for sub in subscriptions.by_user(chat_id)])
+            except TelegramAPIError:
+                metrics.inc("notify_failed")
+            if self._queue and self._queue[0] is item:
+                self._queue.popleft()
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def notification_kb(sub_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🔕 Отписаться", callback_data=f"{NOTIFY_UNSUBSCRIBE_PREFIX}{sub_id}")
+    ]])
+
+
+# лимит на бота общий, поэтому шарды делят его поровну
+notifier = DirectSender(NOTIFY_RATE_PER_SEC / SHARDS, NOTIFY_QUEUE_LIMIT)
+metrics.gauge("notify_queue", notifier.pending)
+metrics.gauge("subscriptions", lambda: len(subscriptions))
+
+
+def notify_subscribers(record: dict) -> int:
+    """Ставит уведомления о новой заявке подписчикам; текст один на всех."""
+    matched = subscriptions.match(record)
+    if matched:
+        text = "🔔 Новая заявка по твоей подписке:\n\n" + render_request(record)
+        for sub in matched:
+            notifier.send(sub["user_id"], text, sub["id"])
+        metrics.inc("notify_queued", len(matched))
+    return len(matched)
+
+
+# ==========================
+# ПОСТЫ В ЧАТЕ И ТАЙМЕРЫ
+# ==========================
+
+class PostIndex:
+    """
+    Где опубликована заявка: request_id -> [(chat_id, message_id, ...)].
+    Поиск по первичному ключу, горячие заявки — в LRU-кэше на cache_size
+    записей. Посты старше retention секунд и посты закрытых заявок удаляются,
+    так что таблица не растёт бесконечно.
+    """
+
+    FIELDS = ("request_id", "chat_id", "message_id", "author_id", "text", "created_at", "thread_id")
+
+    def __init__(self, database: Database, cache_size: int, retention: float):
+        self.db = database
+        self.cache_size = cache_size
+        self.retention = retention
+        self._cache = OrderedDict()
+        self._pruned_at = 0.0
+        self._ready = False
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS posts (
+                request_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                author_id INTEGER,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                thread_id INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (request_id, chat_id, thread_id)
+            );
+            """
+        )
+        await self.db.ensure_column("posts", "thread_id", "INTEGER NOT NULL DEFAULT 0")
+        await self.db.run(self._migrate)
+        await self.db.execute("CREATE INDEX IF NOT EXISTS posts_message ON posts (chat_id, message_id)")
+
+    @staticmethod
+    def _migrate(conn):
+        """Базы, где ключ был (request_id, chat_id): пересоздаём таблицу с темой в ключе."""
+        pk = {row[1]: row[5] for row in conn.execute("PRAGMA table_info(posts)")}
+        if pk.get("thread_id"):
+            return
+        with conn:
+            conn.execute(
+                "CREATE TABLE posts_new (request_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "message_id INTEGER NOT NULL, author_id INTEGER, text TEXT NOT NULL, "
+                "created_at REAL NOT NULL, thread_id INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (request_id, chat_id, thread_id))"
+            )
+            conn.execute(
+                "INSERT INTO posts_new SELECT request_id, chat_id, message_id, author_id, text, "
+                "created_at, thread_id FROM posts"
+            )
+            conn.execute("DROP TABLE posts")
+            conn.execute("ALTER TABLE posts_new RENAME TO posts")
+
+    def _remember(self, request_id: int, items: list):
+        self._cache[request_id] = items
+        self._cache.move_to_end(request_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def add(self, post: dict):
+        await self._prepare()
+        await self.db.execute(
+            "INSERT OR REPLACE INTO posts "
+            "(request_id, chat_id, message_id, author_id, text, created_at, thread_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            tuple(post.get(name, 0) if name == "thread_id" else post[name] for name in self.FIELDS),
+        )
+        items = self._cache.get(post["request_id"])
+        if items is not None:
+            place = (post["chat_id"], post.get("thread_id", 0))
+            items = [p for p in items if (p["chat_id"], p["thread_id"]) != place] + [dict(post)]
+            self._remember(post["request_id"], items)
+        if self.retention and post["created_at"] - self._pruned_at > 3600:
+            await self.prune(post["created_at"] - self.retention)
+
+    async def get(self, request_id: int) -> list:
+        items = self._cache.get(request_id)
+        if items is None:
+            await self._prepare()
+            rows = await self.db.fetchall(
+                "SELECT request_id, chat_id, message_id, author_id, text, created_at, thread_id "
+                "FROM posts WHERE request_id = ?",
+                (request_id,),
+            )
+            items = [dict(zip(self.FIELDS, row)) for row in rows]
+        self._remember(request_id, items)
+        return [dict(p) for p in items]
+
+    async def in_message(self, chat_id: int, message_id: int) -> list:
+        """Все заявки одного сообщения (несколько — если это дайджест)."""
+        await self._prepare()
+        rows = await self.db.fetchall(
+            "SELECT request_id, chat_id, message_id, author_id, text, created_at, thread_id "
+            "FROM posts WHERE chat_id = ? AND message_id = ? ORDER BY request_id",
+            (chat_id, message_id),
+        )
+        return [dict(zip(self.FIELDS, row)) for row in rows]
+
+    async def remove(self, request_id: int):
+        """Забыть посты заявки; строки дайджестов остаются — из них собирается текст."""
+        await self._prepare()
+        self._cache.pop(request_id, None)
+        await self.db.execute(
+            "DELETE FROM posts WHERE request_id = ? AND NOT EXISTS ("
+            "SELECT 1 FROM posts AS other WHERE other.chat_id = posts.chat_id "
+            "AND other.message_id = posts.message_id AND other.request_id != posts.request_id)",
+            (request_id,),
+        )
+
+    async def prune(self, before: float):
+        await self._prepare()
+        self._pruned_at = time.time()
+        self._cache.clear()
+        await self.db.execute("DELETE FROM posts WHERE created_at < ?", (before,))
+
+
+posts = PostIndex(db, POST_CACHE_SIZE, POST_RETENTION)
+
+
+async def on_post_sent(job: dict, message: types.Message):
+    """Запоминаем message_id поста; при переопубликации убираем старый пост."""
+    place = (job["chat_id"], job.get("thread_id", 0))
+    old = {(p["chat_id"], p["thread_id"]): p for p in await posts.get(job["request_id"])}.get(place)
+    # старый дайджест целиком не удаляем: в нём есть и другие заявки
+    shared = old is not None and len(await posts.in_message(old["chat_id"], old["message_id"])) > 1
+    await posts.add({
+        "request_id": job["request_id"],
+        "chat_id": job["chat_id"],
+        "message_id": message.message_id,
+        "author_id": job["author_chat_id"] or (old["author_id"] if old else None),
+        "text": job["text"],
+        "created_at": time.time(),
+        "thread_id": job.get("thread_id", 0),
+    })
+    if old is not None and old["message_id"] != message.message_id and not shared:
+        try:
+            await publish_queue.bot.delete_message(old["chat_id"], old["message_id"])
+        except TelegramAPIError:
+            pass
 
-BOT_TOKEN = os.getenv("TGTOKEN")
-#TARGET_CHAT_ID = -1002909872942 # id чата для публикации заявок
-TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "0"))
 
-COUNTER_FILE = "counter.json"
-TEMPLATES_FILE = "templates.json"
-PUBLISH_CB = "publish_request"
-CANCEL_CB = "cancel_request"
-SAVE_TEMPLATE_CB = "save_template"
-NO_TEMPLATE_CB = "no_template"
-TEMPLATE_SELECT_PREFIX = "tpl:"
-DELETE_TEMPLATE_PREFIX = "dtpl:"
+publish_queue.listeners.append(on_post_sent)
 
-# ==========================
-# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
-# ==========================
 
-def load_json(path: str, default):
-    p = Path(path)
-    if not p.exists():
-        return default
-    try:
-        return json.loads(p.read_text(encoding="utf-8"))
-    except Exception:
-        return default
+class Scheduler:
+    """
+    Все отложенные действия над заявками (истечение, подъём) в одной куче
+    (due, seq, kind, request_id) и одном цикле, а не по задаче на таймер.
+    Расписание дублируется в SQLite и поднимается после рестарта.
+    Перенос и отмена ленивые: устаревшие элементы кучи пропускаются.
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self.handlers = {}
+        self.bot = None
+        self._heap = []
+        self._due = {}
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._ready = False
+        # event loop держит задачи только слабыми ссылками — храним их сами
+        self._firing = set()
+
+    def __len__(self):
+        return len(self._due)
+
+    async def _prepare(self):
+        if self._ready:
+            return
+        self._ready = True
+        await self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS schedule (
+                request_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                due REAL NOT NULL,
+                shard INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (request_id, kind)
+            );
+            """
+        )
+        await self.db.ensure_column("schedule", "shard", "INTEGER NOT NULL DEFAULT 0")
+
+    def _push(self, request_id: int, kind: str, due: float):
+        self._due[(request_id, kind)] = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, kind, request_id))
+        if self._heap[0][3] == request_id and self._heap[0][2] == kind:
+            self._wake.set()
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        await self._prepare()
+        rows = await self.db.fetchall(
+            "SELECT request_id, kind, due FROM schedule WHERE shard % ? = ?", (SHARDS, SHARD_INDEX)
+        )
+        for request_id, kind, due in rows:
+            self._push(request_id, kind, due)
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def schedule(self, request_id: int, kind: str, due: float):
+        await self._prepare()
+        await self.db.execute(
+            "INSERT OR REPLACE INTO schedule (request_id, kind, due, shard) VALUES (?, ?, ?, ?)",
+            (request_id, kind, due, SHARD_INDEX),
+        )
+        self._push(request_id, kind, due)
+
+    async def cancel(self, request_id: int, kind: str = None):
+        await self._prepare()
+        kinds = [kind] if kind else [k for k in self.handlers]
+        for k in kinds:
+            self._due.pop((request_id, k), None)
+        if kind:
+            await self.db.execute(
+                "DELETE FROM schedule WHERE request_id = ? AND kind = ?", (request_id, kind)
+            )
+        else:
+            await self.db.execute("DELETE FROM schedule WHERE request_id = ?", (request_id,))
+
+    async def _loop(self):
+        while True:
+            while self._heap and self._due.get((self._heap[0][3], self._heap[0][2])) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            due, _, kind, request_id = self._heap[0]
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            del self._due[(request_id, kind)]
+            await self.db.execute(
+                "DELETE FROM schedule WHERE request_id = ? AND kind = ? AND due = ?",
+                (request_id, kind, due),
+            )
+            task = asyncio.create_task(self._fire(kind, request_id))
+            self._firing.add(task)
+            task.add_done_callback(self._firing.discard)
+
+    async def _fire(self, kind: str, request_id: int):
+        try:
+            await self.handlers[kind](self.bot, request_id)
+        except Exception:
+            metrics.inc(f"scheduler_{kind}_failed")
 
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # уже начатые истечения и подъёмы доводим до конца
+        if self._firing:
+            await asyncio.gather(*self._firing, return_exceptions=True)
 
-def save_json(path: str, data):
-    p = Path(path)
-    p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+scheduler = Scheduler(db)
+
+EXPIRED_MARK = "\n\n❌ <b>Неактуально</b>"
+CLOSED_MARK = "\n\n🔒 <b>Закрыта автором</b>"
+
+
+async def rewrite_posts(bot: Bot, request_id: int, text: str = None, delete: bool = False) -> int:
+    """
+    Правит на месте (или удаляет) все посты заявки, соблюдая лимиты чата.
+    text=None — к сохранённому тексту поста добавляется отметка EXPIRED_MARK.
+    В дайджесте меняется только раздел заявки, удаление заменяется отметкой.
+    Возвращает, сколько постов удалось изменить.
+    """
+    done = 0
+    for post in await posts.get(request_id):
+        section = post["text"] + EXPIRED_MARK if text is None or delete else text
+        siblings = await posts.in_message(post["chat_id"], post["message_id"])
+        digest = len(siblings) > 1
+        await publish_queue.bucket(post["chat_id"]).acquire()
+        try:
+            if delete and not digest:
+                await bot.delete_message(post["chat_id"], post["message_id"])
+            else:
+                body = section
+                if digest:
+                    body = publish_queue.DIGEST_SEPARATOR.join(
+                        section if p["request_id"] == request_id else p["text"] for p in siblings
+                    )
+                await bot.edit_message_text(
+                    text=body,
+                    chat_id=post["chat_id"],
+                    message_id=post["message_id"],
+                    parse_mode=ParseMode.HTML,
+                )
+                if digest:
+                    publish_queue.note_edit(post["chat_id"], post["message_id"], body)
+                    post["text"] = section
+                    await posts.add(post)
+        except TelegramAPIError:
+            continue
+        done += 1
+    return done
+
+
+async def expire_request(bot: Bot, request_id: int):
+    record = await archive.get(request_id)
+    if record is None or record.get("status") != "open":
+        return
+    await archive.set_status(request_id, "expired")
+    close_request(request_id)
+    await scheduler.cancel(request_id)
+    await rewrite_posts(bot, request_id, delete=EXPIRE_MODE == "delete")
+    await posts.remove(request_id)
+    metrics.inc("request_expired")
 
 
-def get_next_request_id() -> int:
-    data = load_json(COUNTER_FILE, {"last_id": 0})
-    last_id = int(data.get("last_id", 0)) + 1
-    data["last_id"] = last_id
-    save_json(COUNTER_FILE, data)
-    return last_id
+async def bump_request(bot: Bot, request_id: int):
+    record = await archive.get(request_id)
+    if record is None or record.get("status") != "open":
+        return
+    for post in await posts.get(request_id):
+        # старый пост удалит on_post_sent, когда новый будет отправлен
+        await publish_queue.enqueue(post["chat_id"], post["text"], request_id, 0, post["thread_id"])
+    await scheduler.schedule(request_id, "bump", time.time() + BUMP_INTERVAL)
+    metrics.inc("request_bumped")
 
 
-def get_user_templates(user_id: int):
-    data = load_json(TEMPLATES_FILE, {})
-    return data.get(str(user_id), [])
+scheduler.handlers.update(expire=expire_request, bump=bump_request)
 
 
-def save_user_templates(user_id: int, templates):
-    data = load_json(TEMPLATES_FILE, {})
-    data[str(user_id)] = templates
-    save_json(TEMPLATES_FILE, data)
+async def schedule_request_timers(request_id: int, published_at: float):
+    if REQUEST_TTL:
+        await scheduler.schedule(request_id, "expire", published_at + REQUEST_TTL)
+    if BUMP_INTERVAL and (not REQUEST_TTL or BUMP_INTERVAL < REQUEST_TTL):
+        await scheduler.schedule(request_id, "bump", published_at + BUMP_INTERVAL)
 
 
 def format_amount_with_ruble(raw: str) -> str:
@@ -84,6 +3262,104 @@ def format_amount_with_ruble(raw: str) -> str:
     return "\n".join(f"{line} ₽" for line in lines)
 
 
+AMOUNT_UNITS = {"к": 1000, "k": 1000, "тыс": 1000, "млн": 1_000_000, "m": 1_000_000}
+_AMOUNT_UNIT = r"(к|k|тыс\.?|млн\.?|m)?"
+# строка целиком: число [единица] [- число [единица]]
+AMOUNT_RE = re.compile(
+    rf"\s*(\d[\d\s.,]*?)\s*{_AMOUNT_UNIT}\s*(?:[-–—]\s*(\d[\d\s.,]*?)\s*{_AMOUNT_UNIT})?\s*",
+    re.IGNORECASE,
+)
+
+
+def amount_unit(raw) -> int:
+    return AMOUNT_UNITS[raw.lower().rstrip(".")] if raw else 1
+
+
+def parse_number(raw: str):
+    raw = raw.replace(" ", "").replace("\u00a0", "").replace(",", ".").rstrip(".")
+    if raw.count(".") > 1:
+        raw = raw.replace(".", "")
+    elif "." in raw and len(raw.split(".")[1]) == 3:
+        # 100.000 — разделитель тысяч, а не дробная часть
+        raw = raw.replace(".", "")
+    try:
+        return float(raw)
+    except ValueError:
+        return None
+
+
+def parse_amounts(raw: str) -> list:
+    """
+    Суммы из текста пользователя в виде списка [lo, hi].
+    «100000» -> [100000, 100000], «100 000-300к» -> [100000, 300000],
+    «50к-1,5млн» -> [50000, 1500000]. Строки, которые не удалось разобрать
+    целиком, пропускаются.
+    """
+    ranges = []
+    for line in raw.splitlines():
+        m = AMOUNT_RE.fullmatch(line)
+        if not m:
+            continue
+        lo = parse_number(m.group(1))
+        hi = parse_number(m.group(3)) if m.group(3) else lo
+        if lo is None or hi is None:
+            continue
+        lo_unit, hi_unit = amount_unit(m.group(2)), amount_unit(m.group(4))
+        if m.group(3):
+            if m.group(4) and not m.group(2) and lo < 1000:
+                # «100-300к» — обе границы в тысячах
+                lo_unit = hi_unit
+            elif m.group(2) and not m.group(4) and hi < lo * lo_unit:
+                # «100к-300» — и вторая граница в тысячах
+                hi_unit = lo_unit
+        else:
+            hi_unit = lo_unit
+        lo, hi = lo * lo_unit, hi * hi_unit
+        if hi < lo:
+            lo, hi = hi, lo
+        ranges.append([lo, hi])
+    return ranges
+
+
+RATE_RE = re.compile(r"[0-9]+(?:[.,][0-9]+)?")
+
+
+def parse_rate(raw: str):
+    """«83,15» -> Decimal('83.15'); None, если это не положительное число."""
+    raw = str(raw).strip().replace(" ", "")
+    # Decimal принимает и «1e3», и «1_000» — такое курсом не считаем
+    if not RATE_RE.fullmatch(raw):
+        return None
+    try:
+        rate = Decimal(raw.replace(",", "."))
+    except InvalidOperation:
+        return None
+    if rate <= 0:
+        return None
+    return rate
+
+
+def direction_label(direction) -> str:
+    return "Приму RUB" if direction == DIRECTION_RECEIVE else "Отправлю RUB"
+
+
+def render_request(record: dict) -> str:
+    """Текст заявки для публикации (HTML)."""
+    amount_formatted = format_amount_with_ruble(record.get("amount") or "")
+    return (
+        f"📩 <b>Заявка №{record.get('request_id')}</b>\n\n"
+        f"👤 От: {record.get('author')}\n\n"
+        f"🔁 Направление: <b>{direction_label(record.get('direction'))}</b>\n"
+        f"💰 Сумма:\n<b>{amount_formatted}</b>\n\n"
+        f"💱 Курс: <b>{record.get('rate')}</b>\n"
+        f"🏦 Банк: <b>{record.get('bank')}</b>\n"
+        f"📥 Источник трафика: <b>{record.get('traffic')}</b>\n"
+        f"📈 Биржа: <b>{record.get('exchange')}</b>\n"
+        f"📄 Условия: <b>{record.get('conditions')}</b>\n"
+        f"📲 Контакт для связи: <b>{record.get('contact')}</b>\n"
+    )
+
+
 # ==========================
 # СОСТОЯНИЯ FSM
 # ==========================
@@ -107,149 +3383,196 @@ class RequestStates(StatesGroup):
 # ==========================
 # КЛАВИАТУРЫ
 # ==========================
+# Все клавиатуры собираются один раз при старте и дальше только переиспользуются.
 
-def direction_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="Принять RUB"),
-                KeyboardButton(text="Отправить RUB"),
-            ],
-            [KeyboardButton(text="Использовать шаблон")],
-            [KeyboardButton(text="Управлять шаблонами")],  # <--- ДОБАВИЛИ СТРОКУ
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
-
-
-def bank_kb() -> ReplyKeyboardMarkup:
+def reply_kb(rows) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Любой банк (СБП)")],
-            [KeyboardButton(text="Только Сбербанк")],
-            [KeyboardButton(text="Только Т-Банк")],
-            [KeyboardButton(text="✍️ Написать свои условия по банкам")],
-        ],
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in rows],
         resize_keyboard=True,
         one_time_keyboard=True,
     )
 
 
-def traffic_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Личная карта")],
-            [KeyboardButton(text="БТ (белый треугольник)")],
-            [KeyboardButton(text="Процессинг")],
-            [KeyboardButton(text="Свой обменник")],
-            [KeyboardButton(text="Товарка")],
-            [KeyboardButton(text="Обмен юаней")],
-            [KeyboardButton(text="✍️ Другое (написать источник)")],
+DIRECTION_RECEIVE = "Принять RUB"
+DIRECTION_SEND = "Отправить RUB"
+DIRECTIONS = frozenset((DIRECTION_RECEIVE, DIRECTION_SEND))
+
+DIRECTION_KB = reply_kb([
+    (DIRECTION_RECEIVE, DIRECTION_SEND),
+    ("Использовать шаблон",),
+    ("Управлять шаблонами",),
+])
+BACK_TO_MAIN_KB = reply_kb([("В главное меню",)])
+NEW_REQUEST_KB = reply_kb([("Создать новую заявку",)])
+CONTACT_KB = reply_kb([("Использовать текущий контакт",)])
+REMOVE_KB = ReplyKeyboardRemove()
+
+PREVIEW_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="✅ Опубликовать",
+                callback_data=PUBLISH_CB,
+            )
         ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
-
-def exchange_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Bybit"), KeyboardButton(text="HTX"), KeyboardButton(text="Bybit/HTX")]
+        [
+            InlineKeyboardButton(
+                text="❌ Отменить",
+                callback_data=CANCEL_CB,
+            )
         ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
+    ]
+)
 
-def conditions_receive_kb() -> ReplyKeyboardMarkup:
-    # для направления "Принять RUB"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Чек PDF")],
-            [KeyboardButton(text="Чек на почту")],
-            [KeyboardButton(text="Одним платежом")],
-            [KeyboardButton(text="Могу принять частями")],
-            [KeyboardButton(text="✍️ Написать свои условия")],
+AFTER_PUBLISH_TEMPLATE_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="💾 Сохранить как шаблон",
+                callback_data=SAVE_TEMPLATE_CB,
+            )
         ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
-
-def conditions_send_kb() -> ReplyKeyboardMarkup:
-    # для направления "Отправить RUB"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Одним платежом")],
-            [KeyboardButton(text="Могу отправить частями")],
-            [KeyboardButton(text="✍️ Написать свои условия")],
+        [
+            InlineKeyboardButton(
+                text="Не сохранять",
+                callback_data=NO_TEMPLATE_CB,
+            )
         ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-def back_to_main_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="В главное меню")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
-
-
-def new_request_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Создать новую заявку")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-
-
-def contact_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Использовать текущий контакт")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    ]
+)
 
 
-def preview_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="✅ Опубликовать",
-                    callback_data=PUBLISH_CB,
-                )
+# ==========================
+# СЦЕНАРИЙ ЗАЯВКИ
+# ==========================
+# Шаги с выбором из кнопок описаны декларативно. Шаги идут по порядку,
+# после последнего спрашиваем контакт. options: направление -> ряды кнопок,
+# ключ None — вариант для всех остальных направлений. custom — кнопка
+# «написать своё», состояние для ввода и подсказка.
+
+FLOW = (
+    {
+        "field": "bank",
+        "state": RequestStates.bank,
+        "prompt": "Выберите банк:",
+        "error": "Пожалуйста, выберите вариант с кнопок.",
+        "options": {
+            None: [
+                ("Любой банк (СБП)",),
+                ("Только Сбербанк",),
+                ("Только Т-Банк",),
             ],
-            [
-                InlineKeyboardButton(
-                    text="❌ Отменить",
-                    callback_data=CANCEL_CB,
-                )
+        },
+        "custom": (
+            "✍️ Написать свои условия по банкам",
+            RequestStates.bank_custom,
+            "Напишите свои условия по банкам (например, «только Сбер/Т-Банк, без других»).",
+        ),
+    },
+    {
+        "field": "traffic",
+        "state": RequestStates.traffic,
+        "prompt": "Выберите источник трафика:",
+        "error": "Пожалуйста, выберите источник трафика с кнопок.",
+        "options": {
+            None: [
+                ("Личная карта",),
+                ("БТ (белый треугольник)",),
+                ("Процессинг",),
+                ("Свой обменник",),
+                ("Товарка",),
+                ("Обмен юаней",),
             ],
-        ]
-    )
-
-
-def after_publish_template_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="💾 Сохранить как шаблон",
-                    callback_data=SAVE_TEMPLATE_CB,
-                )
+        },
+        "custom": (
+            "✍️ Другое (написать источник)",
+            RequestStates.traffic_custom,
+            "Напишите источник трафика (например, «свои клиенты», «за рекламу» и т.п.).",
+        ),
+    },
+    {
+        "field": "exchange",
+        "state": RequestStates.exchange,
+        "prompt": "Выберите биржу, на которой размещена заявка:",
+        "error": "Пожалуйста, выберите биржу с кнопок.",
+        "options": {
+            None: [("Bybit", "HTX", "Bybit/HTX")],
+        },
+    },
+    {
+        "field": "conditions",
+        "state": RequestStates.conditions,
+        "prompt": "Выберите дополнительные условия:",
+        "error": "Пожалуйста, выберите вариант с кнопок.",
+        "options": {
+            DIRECTION_RECEIVE: [
+                ("Чек PDF",),
+                ("Чек на почту",),
+                ("Одним платежом",),
+                ("Могу принять частями",),
             ],
-            [
-                InlineKeyboardButton(
-                    text="Не сохранять",
-                    callback_data=NO_TEMPLATE_CB,
-                )
+            None: [
+                ("Одним платежом",),
+                ("Могу отправить частями",),
             ],
-        ]
-    )
+        },
+        "custom": (
+            "✍️ Написать свои условия",
+            RequestStates.conditions_custom,
+            "Напишите свои условия по сделке (или «без доп. условий»).",
+        ),
+    },
+)
+
+
+@dataclass(frozen=True)
+class FlowStep:
+    field: str
+    state: State
+    prompt: str
+    error: str
+    keyboards: MappingProxyType
+    valid: MappingProxyType
+    custom_option: str = ""
+    custom_state: State = None
+    custom_prompt: str = ""
+    by_direction: bool = False
+
+    def keyboard(self, direction) -> ReplyKeyboardMarkup:
+        return self.keyboards.get(direction) or self.keyboards[None]
+
+    def options(self, direction) -> frozenset:
+        return self.valid.get(direction) or self.valid[None]
+
+
+def compile_flow(spec) -> tuple:
+    steps = []
+    for item in spec:
+        custom_option, custom_state, custom_prompt = item.get("custom", ("", None, ""))
+        keyboards = {}
+        valid = {}
+        for direction, rows in item["options"].items():
+            kb_rows = list(rows)
+            if custom_option:
+                kb_rows.append((custom_option,))
+            keyboards[direction] = reply_kb(kb_rows)
+            valid[direction] = frozenset(text for row in rows for text in row)
+        steps.append(FlowStep(
+            field=item["field"],
+            state=item["state"],
+            prompt=item["prompt"],
+            error=item["error"],
+            keyboards=MappingProxyType(keyboards),
+            valid=MappingProxyType(valid),
+            custom_option=custom_option,
+            custom_state=custom_state,
+            custom_prompt=custom_prompt,
+            by_direction=len(keyboards) > 1,
+        ))
+    return tuple(steps)
+
+
+FLOW_STEPS = compile_flow(FLOW)
 
 
 # ==========================
@@ -262,7 +3585,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         "Привет! Я бот для создания заявок на обмен в чат "
         "<a href='https://t.me/+MLjt_rkqxpIwMjJi'>Заявки P2P</a>.\n\n"
         "Заявку в каком направлении вы хотите создать?",
-        reply_markup=direction_kb(),
+        reply_markup=DIRECTION_KB,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True,
     )
@@ -275,31 +3598,50 @@ async def new_request(message: types.Message, state: FSMContext):
 
 # ---------- Направление / шаблоны ----------
 
+def templates_kb(user_id: int, mode: str, page: int):
+    """
+    Одна страница списка шаблонов: mode "s" — выбор, "d" — удаление.
+    Возвращает (клавиатура, номер страницы) или (None, 0), если шаблонов нет.
+    """
+    total = templates_store.count(user_id)
+    if not total:
+        return None, 0
+    pages = (total + TEMPLATES_PAGE_SIZE - 1) // TEMPLATES_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    rows = []
+    for tpl in templates_store.page(user_id, page * TEMPLATES_PAGE_SIZE, TEMPLATES_PAGE_SIZE):
+        name = tpl.get("name") or f"Шаблон {tpl['id']}"
+        if mode == "d":
+            rows.append([InlineKeyboardButton(
+                text=f"🗑 {name}", callback_data=f"{DELETE_TEMPLATE_PREFIX}{page}:{tpl['id']}",
+            )])
+        else:
+            rows.append([InlineKeyboardButton(
+                text=name, callback_data=f"{TEMPLATE_SELECT_PREFIX}{tpl['id']}",
+            )])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(
+            text="← Назад", callback_data=f"{TEMPLATE_PAGE_PREFIX}{mode}:{page - 1}",
+        ))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(
+            text=f"Ещё → ({page + 2}/{pages})", callback_data=f"{TEMPLATE_PAGE_PREFIX}{mode}:{page + 1}",
+        ))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows), page
+
+
 async def use_template(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    templates = get_user_templates(user_id)
-    if not templates:
+    kb, _ = templates_kb(message.from_user.id, "s", 0)
+    if kb is None:
         await message.answer(
             "У тебя пока нет шаблонов.\n"
             "Создай заявку до конца, после публикации я предложу сохранить её как шаблон.",
-            reply_markup=back_to_main_kb(),  # <-- ДОБАВИЛИ КНОПКУ
+            reply_markup=BACK_TO_MAIN_KB,  # <-- ДОБАВИЛИ КНОПКУ
         )
         return
-    ...
-
-
-    buttons = []
-    for idx, tpl in enumerate(templates):
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    text=tpl.get("name", f"Шаблон {idx+1}"),
-                    callback_data=f"{TEMPLATE_SELECT_PREFIX}{idx}",
-                )
-            ]
-        )
-
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     # сообщение с шаблонами (inline-кнопки)
     await message.answer(
@@ -310,33 +3652,18 @@ async def use_template(message: types.Message, state: FSMContext):
     # отдельным сообщением даём кнопку "В главное меню"
     await message.answer(
         "Если передумал, нажми «В главное меню».",
-        reply_markup=back_to_main_kb(),
+        reply_markup=BACK_TO_MAIN_KB,
     )
-async def manage_templates(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    templates = get_user_templates(user_id)
 
-    if not templates:
+async def manage_templates(message: types.Message, state: FSMContext):
+    kb, _ = templates_kb(message.from_user.id, "d", 0)
+    if kb is None:
         await message.answer(
             "У тебя пока нет шаблонов.",
-            reply_markup=direction_kb(),
+            reply_markup=DIRECTION_KB,
         )
         return
 
-    buttons = []
-    for idx, tpl in enumerate(templates):
-        name = tpl.get("name", f"Шаблон {idx+1}")
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    text=f"🗑 {name}",
-                    callback_data=f"{DELETE_TEMPLATE_PREFIX}{idx}",
-                )
-            ]
-        )
-
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-
     await message.answer(
         "Выбери шаблон, который хочешь удалить:",
         reply_markup=kb,
@@ -345,30 +3672,36 @@ async def manage_templates(message: types.Message, state: FSMContext):
     # ДОБАВЛЯЕМ ЭТО ↓↓↓
     await message.answer(
         "Если передумал — нажми «В главное меню»",
-        reply_markup=back_to_main_kb(),
+        reply_markup=BACK_TO_MAIN_KB,
     )
 
 
-async def template_selected(callback: CallbackQuery, state: FSMContext):
-    data = callback.data
-    if not data.startswith(TEMPLATE_SELECT_PREFIX):
+async def template_page_callback(callback: CallbackQuery, state: FSMContext):
+    try:
+        mode, page = callback.data[len(TEMPLATE_PAGE_PREFIX):].split(":", 1)
+        page = int(page)
+    except ValueError:
+        await callback.answer()
         return
+    kb, _ = templates_kb(callback.from_user.id, mode, page)
+    await callback.answer()
+    if kb is None:
+        await callback.message.edit_text("У тебя пока нет шаблонов.")
+        return
+    await callback.message.edit_reply_markup(reply_markup=kb)
 
-    user_id = callback.from_user.id
-    templates = get_user_templates(user_id)
 
-    try:
-        idx = int(data.split(":", 1)[1])
-    except Exception:
-        await callback.answer("Ошибка шаблона", show_alert=True)
-        return
+async def legacy_template_callback(callback: CallbackQuery, state: FSMContext):
+    await callback.answer("Эта кнопка устарела — открой список шаблонов заново.", show_alert=True)
 
-    if idx < 0 or idx >= len(templates):
+
+async def template_selected(callback: CallbackQuery, state: FSMContext):
+    template_id = callback.data[len(TEMPLATE_SELECT_PREFIX):]
+    tpl = templates_store.find(callback.from_user.id, template_id)
+    if tpl is None:
         await callback.answer("Шаблон не найден", show_alert=True)
         return
 
-    tpl = templates[idx]
-
     await state.update_data(
         direction=tpl.get("direction"),
         bank=tpl.get("bank"),
@@ -377,7 +3710,7 @@ async def template_selected(callback: CallbackQuery, state: FSMContext):
         conditions=tpl.get("conditions"),
     )
 
-    await callback.answer(f"Шаблон «{tpl.get('name', f'Шаблон {idx+1}')}» выбран.")
+    await callback.answer(f"Шаблон «{tpl.get('name') or f'Шаблон {template_id}'}» выбран.")
     await callback.message.answer(
         "Использую выбранный шаблон.\n\n"
         f"🔁 Направление: {tpl.get('direction')}\n"
@@ -388,52 +3721,33 @@ async def template_selected(callback: CallbackQuery, state: FSMContext):
         "Теперь введи сумму заявки одним сообщением.\n"
         "Можно несколько сумм, каждую с новой строки.\n"
         "Например: 100000\n20000-50000",
-        reply_markup=ReplyKeyboardRemove(),
+        reply_markup=REMOVE_KB,
     )
 
     await state.set_state(RequestStates.amount)
 
 async def delete_template_callback(callback: CallbackQuery, state: FSMContext):
-    data = callback.data
-    if not data.startswith(DELETE_TEMPLATE_PREFIX):
-        return
-
     user_id = callback.from_user.id
-    templates = get_user_templates(user_id)
-
     try:
-        idx = int(data.split(":", 1)[1])
-    except Exception:
+        page, template_id = callback.data[len(DELETE_TEMPLATE_PREFIX):].split(":", 1)
+        page = int(page)
+    except ValueError:
         await callback.answer("Ошибка удаления шаблона", show_alert=True)
         return
 
-    if idx < 0 or idx >= len(templates):
+    removed = await templates_store.remove(user_id, template_id)
+    if removed is None:
         await callback.answer("Шаблон не найден", show_alert=True)
         return
 
-    removed = templates.pop(idx)
-    save_user_templates(user_id, templates)
-
     await callback.answer(f"Шаблон «{removed.get('name', 'без названия')}» удалён ✅", show_alert=True)
 
-    # Перерисуем список оставшихся шаблонов
-    if not templates:
+    # Перерисуем страницу оставшихся шаблонов
+    kb, _ = templates_kb(user_id, "d", page)
+    if kb is None:
         await callback.message.edit_text("Все шаблоны удалены.")
         return
 
-    buttons = []
-    for i, tpl in enumerate(templates):
-        name = tpl.get("name", f"Шаблон {i+1}")
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    text=f"🗑 {name}",
-                    callback_data=f"{DELETE_TEMPLATE_PREFIX}{i}",
-                )
-            ]
-        )
-
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await callback.message.edit_text(
         "Выбери шаблон, который хочешь удалить:",
         reply_markup=kb,
@@ -445,10 +3759,10 @@ async def back_to_main(message: types.Message, state: FSMContext):
 
 
 async def direction_chosen(message: types.Message, state: FSMContext):
-    if message.text not in ["Принять RUB", "Отправить RUB"]:
+    if message.text not in DIRECTIONS:
         await message.answer(
             "Пожалуйста, выберите направление с кнопок ниже.",
-            reply_markup=direction_kb(),
+            reply_markup=DIRECTION_KB,
         )
         return
 
@@ -460,7 +3774,7 @@ async def direction_chosen(message: types.Message, state: FSMContext):
         "Примеры:\n"
         "<code>150000</code>\n"
         "<code>100000-300000</code>",
-        reply_markup=ReplyKeyboardRemove(),
+        reply_markup=REMOVE_KB,
         parse_mode=ParseMode.HTML,
     )
     await state.set_state(RequestStates.amount)
@@ -477,21 +3791,24 @@ async def amount_chosen(message: types.Message, state: FSMContext):
         )
         return
 
-    # проверяем, что каждая непустая строка начинается с цифры
+    # каждая непустая строка должна разбираться как сумма или диапазон целиком:
+    # иначе в поиск, подбор встречных и статистику попали бы неверные суммы
     lines = [line.strip() for line in text.splitlines() if line.strip()]
     for line in lines:
-        if not line[0].isdigit():
+        if not parse_amounts(line):
             await message.answer(
-                "Каждая строка с суммой должна начинаться с цифры.\n\n"
+                f"Не понял сумму «{html.escape(line)}».\n\n"
+                "Каждая строка — сумма или диапазон, можно с «к» и «млн».\n"
                 "Примеры допустимого ввода:\n"
                 "<code>150000</code>\n"
-                "<code>100000-300000</code>\n\n"
+                "<code>100000-300000</code>\n"
+                "<code>50к-1,5млн</code>\n\n"
                 "Можно несколько строк подряд.",
                 parse_mode=ParseMode.HTML,
             )
             return
 
-    await state.update_data(amount=text)
+    await state.update_data(amount=text, amount_ranges=parse_amounts(text))
     await message.answer(
         "Теперь введите курс обмена.\n\n"
         "Например: <code>83,15</code> .",
@@ -508,7 +3825,16 @@ async def rate_chosen(message: types.Message, state: FSMContext):
         await message.answer("Пожалуйста, введите курс обмена.")
         return
 
-    await state.update_data(rate=text)
+    rate = parse_rate(text)
+    if rate is None:
+        await message.answer(
+            "Курс должен быть числом.\n\n"
+            "Например: <code>83,15</code> .",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
+    await state.update_data(rate=text, rate_value=str(rate))
 
     data = await state.get_data()
     # Если заявка создана из шаблона и у нас уже есть
@@ -517,170 +3843,76 @@ async def rate_chosen(message: types.Message, state: FSMContext):
         await ask_contact(message, state)
         return
 
-    await message.answer(
-        "Выберите банк:",
-        reply_markup=bank_kb(),
-    )
-    await state.set_state(RequestStates.bank)
-
-
-async def bank_chosen(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-
-    if text == "✍️ Написать свои условия по банкам":
-        await message.answer(
-            "Напишите свои условия по банкам (например, «только Сбер/Т-Банк, без других»).",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-        await state.set_state(RequestStates.bank_custom)
-        return
-
-    if text not in [
-        "Любой банк (СБП)",
-        "Только Сбербанк",
-        "Только Т-Банк",
-    ]:
-        await message.answer(
-            "Пожалуйста, выберите вариант с кнопок.",
-            reply_markup=bank_kb(),
-        )
-        return
-
-    await state.update_data(bank=text)
-    await message.answer(
-        "Выберите источник трафика:",
-        reply_markup=traffic_kb(),
-    )
-    await state.set_state(RequestStates.traffic)
-
-
-async def bank_custom_entered(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    await state.update_data(bank=text)
-
-    await message.answer(
-        "Выберите источник трафика:",
-        reply_markup=traffic_kb(),
-    )
-    await state.set_state(RequestStates.traffic)
-
+    await enter_step(message, state, 0)
 
-async def traffic_chosen(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-
-    if text == "✍️ Другое (написать источник)":
-        await message.answer(
-            "Напишите источник трафика (например, «свои клиенты», «за рекламу» и т.п.).",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-        await state.set_state(RequestStates.traffic_custom)
-        return
 
-    valid = [
-        "Личная карта",
-        "БТ (белый треугольник)",
-        "Процессинг",
-        "Свой обменник",
-        "Товарка",
-        "Обмен юаней",
-    ]
-    if text not in valid:
-        await message.answer(
-            "Пожалуйста, выберите источник трафика с кнопок.",
-            reply_markup=traffic_kb(),
-        )
+async def enter_step(message: types.Message, state: FSMContext, index: int):
+    """Переход к шагу FLOW_STEPS[index]; после последнего шага — к контакту."""
+    if index >= len(FLOW_STEPS):
+        await ask_contact(message, state)
         return
 
-    await state.update_data(traffic=text)
-    await message.answer(
-        "Выберите биржу, на которой размещена заявка:",
-        reply_markup=exchange_kb(),
-    )
-    await state.set_state(RequestStates.exchange)
-
-
-async def traffic_custom_entered(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    await state.update_data(traffic=text)
-
+    step = FLOW_STEPS[index]
+    direction = None
+    if step.by_direction:
+        direction = (await state.get_data()).get("direction")
     await message.answer(
-        "Выберите биржу, на которой размещена заявка:",
-        reply_markup=exchange_kb(),
+        step.prompt,
+        reply_markup=step.keyboard(direction),
     )
-    await state.set_state(RequestStates.exchange)
+    await state.set_state(step.state)
 
 
-async def exchange_chosen(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    if text not in ["Bybit", "HTX", "Bybit/HTX"]:
-        await message.answer(
-            "Пожалуйста, выберите биржу с кнопок.",
-            reply_markup=exchange_kb(),
-        )
-        return
+def make_choice_handler(index: int):
+    step = FLOW_STEPS[index]
 
-    await state.update_data(exchange=text)
-    data = await state.get_data()
-    direction = data.get("direction")
-
-    if direction == "Принять RUB":
-        kb = conditions_receive_kb()
-    else:
-        kb = conditions_send_kb()
+    async def handler(message: types.Message, state: FSMContext):
+        text = (message.text or "").strip()
 
-    await message.answer(
-        "Выберите дополнительные условия:",
-        reply_markup=kb,
-    )
-    await state.set_state(RequestStates.conditions)
+        if step.custom_option and text == step.custom_option:
+            await message.answer(
+                step.custom_prompt,
+                reply_markup=REMOVE_KB,
+            )
+            await state.set_state(step.custom_state)
+            return
 
+        direction = None
+        if step.by_direction:
+            direction = (await state.get_data()).get("direction")
+        if text not in step.options(direction):
+            await message.answer(
+                step.error,
+                reply_markup=step.keyboard(direction),
+            )
+            return
 
-async def conditions_chosen(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    data = await state.get_data()
-    direction = data.get("direction")
+        await state.update_data({step.field: text})
+        await enter_step(message, state, index + 1)
 
-    if text == "✍️ Написать свои условия":
-        await message.answer(
-            "Напишите свои условия по сделке (или «без доп. условий»).",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-        await state.set_state(RequestStates.conditions_custom)
-        return
+    handler.__name__ = handler.__qualname__ = f"{step.field}_chosen"
+    return handler
 
-    if direction == "Принять RUB":
-        valid = [
-            "Чек PDF",
-            "Чек на почту",
-            "Одним платежом",
-            "Могу принять частями",
-        ]
-    else:
-        valid = [
-            "Одним платежом",
-            "Могу отправить частями",
-        ]
 
-    if text not in valid:
-        if direction == "Принять RUB":
-            kb = conditions_receive_kb()
-        else:
-            kb = conditions_send_kb()
+def make_custom_handler(index: int):
+    step = FLOW_STEPS[index]
 
-        await message.answer(
-            "Пожалуйста, выберите вариант с кнопок.",
-            reply_markup=kb,
-        )
-        return
+    async def handler(message: types.Message, state: FSMContext):
+        text = (message.text or "").strip()
+        await state.update_data({step.field: text})
+        await enter_step(message, state, index + 1)
 
-    await state.update_data(conditions=text)
-    await ask_contact(message, state)
+    handler.__name__ = handler.__qualname__ = f"{step.field}_custom_entered"
+    return handler
 
 
-async def conditions_custom_entered(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    await state.update_data(conditions=text)
-    await ask_contact(message, state)
+def register_flow(dp: Dispatcher):
+    for index, step in enumerate(FLOW_STEPS):
+        dp.message.register(make_choice_handler(index), step.state, F.chat.type == ChatType.PRIVATE)
+        if step.custom_state is not None:
+            dp.message.register(
+                make_custom_handler(index), step.custom_state, F.chat.type == ChatType.PRIVATE
+            )
 
 
 async def ask_contact(message: types.Message, state: FSMContext):
@@ -696,14 +3928,14 @@ async def ask_contact(message: types.Message, state: FSMContext):
             f"– Нажми «Использовать текущий контакт»\n"
             f"– Или введи другой контакт, начинающийся с <code>@</code>",
             parse_mode=ParseMode.HTML,
-            reply_markup=contact_kb(),
+            reply_markup=CONTACT_KB,
         )
     else:
         await message.answer(
             "Укажи контакт для связи по заявке.\n\n"
             "Введи ник, начинающийся с символа <code>@</code> (например, <code>@username</code>).",
             parse_mode=ParseMode.HTML,
-            reply_markup=ReplyKeyboardRemove(),
+            reply_markup=REMOVE_KB,
         )
 
     await state.set_state(RequestStates.contact)
@@ -726,43 +3958,14 @@ async def contact_chosen(message: types.Message, state: FSMContext):
             return
         contact = text
 
-    await state.update_data(contact=contact)
-
     # формируем черновик заявки + номер
-    data = await state.get_data()
-
-    direction = data.get("direction")
-    raw_amount = data.get("amount")
-    rate = data.get("rate")
-    bank = data.get("bank")
-    traffic = data.get("traffic")
-    exchange = data.get("exchange")
-    conditions = data.get("conditions")
-    contact = data.get("contact")
-
-    if direction == "Принять RUB":
-        direction_label = "Приму RUB"
-    else:
-        direction_label = "Отправлю RUB"
-
-    request_id = get_next_request_id()
-    await state.update_data(request_id=request_id)
-
-    user_mention = message.from_user.mention_html()
-    amount_formatted = format_amount_with_ruble(raw_amount or "")
-
-    text_out = (
-        f"📩 <b>Заявка №{request_id}</b>\n\n"
-        f"👤 От: {user_mention}\n\n"
-        f"🔁 Направление: <b>{direction_label}</b>\n"
-        f"💰 Сумма:\n<b>{amount_formatted}</b>\n\n"
-        f"💱 Курс: <b>{rate}</b>\n"
-        f"🏦 Банк: <b>{bank}</b>\n"
-        f"📥 Источник трафика: <b>{traffic}</b>\n"
-        f"📈 Биржа: <b>{exchange}</b>\n"
-        f"📄 Условия: <b>{conditions}</b>\n"
-        f"📲 Контакт для связи: <b>{contact}</b>\n"
+    request_id = await get_next_request_id()
+    data = await state.update_data(
+        contact=contact,
+        request_id=request_id,
+        author=message.from_user.mention_html(),
     )
+    text_out = render_request(data)
 
     await state.update_data(preview_text=text_out)
 
@@ -772,7 +3975,7 @@ async def contact_chosen(message: types.Message, state: FSMContext):
         f"{text_out}\n"
         "Если всё верно — нажми «Опубликовать». Если нет — «Отменить» и создай заново.",
         parse_mode=ParseMode.HTML,
-        reply_markup=preview_kb(),
+        reply_markup=PREVIEW_KB,
     )
 
     await state.set_state(RequestStates.confirm)
@@ -788,49 +3991,108 @@ async def callback_publish(callback: CallbackQuery, state: FSMContext, bot: Bot)
     if not text_out:
         await callback.answer("Нет заявки для публикации", show_alert=True)
         return
-
-    if TARGET_CHAT_ID == 0:
+    key = f"request:{request_id}"
+    record = request_record(data, callback.from_user.id)
+    destinations = routes.destinations(record)
+    if not destinations and publish_marks.cache.get(key) is None:
+        # ни один маршрут не подошёл — заявку не публикуем и никуда не записываем
+        metrics.inc("publish_unrouted")
+        await callback.answer("Заявку некуда опубликовать.", show_alert=True)
         await callback.message.answer(
-            "⚠️ TARGET_CHAT_ID не задан. Заявка не может быть отправлена в чат.\n\n"
-            "Сейчас я просто покажу, как она выглядит:",
-            parse_mode=ParseMode.HTML,
+            "⚠️ Для такой заявки не задан чат (TARGET_CHAT_ID или ROUTES_FILE), "
+            "поэтому она не опубликована. Нажми «Отменить» и создай заявку с другими "
+            "условиями или напиши администратору."
         )
-        await callback.message.answer(text_out, parse_mode=ParseMode.HTML)
-    else:
-        try:
-            await bot.send_message(
-                chat_id=TARGET_CHAT_ID,
-                text=text_out,
-                parse_mode=ParseMode.HTML,
-            )
-        except Exception:
-            await callback.message.answer(
-                "⚠️ Не удалось отправить заявку в целевой чат. "
-                "Проверь, что бот добавлен в этот чат и имеет право писать сообщения.",
-            )
-            await callback.message.answer(text_out, parse_mode=ParseMode.HTML)
+        return
+    if await publish_marks.claim(key, request_id) is not None:
+        metrics.inc("publish_duplicate")
+        await callback.answer(f"Заявка №{request_id} уже опубликована.")
+        return
 
-    await callback.answer("Заявка опубликована!")
+    try:
+        # отправкой в чаты занимается очередь: лимиты Telegram и повторы там
+        matches, positions = await publish_record(
+            record, destinations, text_out, callback.message.chat.id
+        )
+    except Exception:
+        await publish_failed(callback, key)
+        raise
 
-    await callback.message.answer(
-        f"✅ Заявка №{request_id} отправлена в чат!",
-        reply_markup=new_request_kb(),
+    await callback.answer("Заявка поставлена в очередь!")
+    status = (
+        f"✅ Заявка №{request_id} принята и поставлена в очередь на публикацию "
+        f"{publish_targets_note(positions)}."
     )
 
+    await callback.message.answer(status, reply_markup=close_request_kb(request_id))
+
+    if matches:
+        await callback.message.answer(render_matches(matches))
+
     # предложение сохранить шаблон
     await callback.message.answer(
         "Хочешь сохранить эту заявку как шаблон для быстрых заявок в будущем?",
-        reply_markup=after_publish_template_kb(),
+        reply_markup=AFTER_PUBLISH_TEMPLATE_KB,
     )
     # состояние пока не чистим — данные нужны для шаблона
 
 
+async def publish_record(record: dict, destinations: list, text: str, author_chat_id: int):
+    """
+    Публикация заявки. Сначала всё, что пишет в базу: архив, таймеры, очередь
+    отправки; если что-то из этого упало, уже записанное откатывается, чтобы
+    повтор прошёл заново. Потом индексы, статистика и подписчики — в памяти.
+    Возвращает (встречные заявки, позиции в очередях).
+    """
+    request_id = record["request_id"]
+    await archive.add(record)
+    try:
+        await schedule_request_timers(request_id, record["created_at"])
+        positions = await publish_queue.enqueue_many(destinations, text, request_id, author_chat_id)
+    except Exception:
+        await scheduler.cancel(request_id)
+        await archive.delete(request_id)
+        raise
+    matches = match_index.find(record)
+    open_request(record)
+    stats.record(record)
+    notify_subscribers(record)
+    # последние сумма и курс автора подставляются в inline-результаты
+    inline_cache.invalidate(record["author_id"])
+    return matches, positions
+
+
+async def publish_failed(callback: CallbackQuery, key: str):
+    """Публикация упала (например, база занята): снимаем отметку, чтобы можно было нажать ещё раз."""
+    metrics.inc("publish_failed")
+    await publish_marks.release(key)
+    await callback.answer("Не получилось опубликовать заявку. Попробуй нажать ещё раз.", show_alert=True)
+
+
+def publish_targets_note(positions: list) -> str:
+    if len(positions) == 1:
+        return f"(позиция {positions[0]})"
+    return f"(чатов: {len(positions)}, позиция до {max(positions)})"
+
+
+def request_line(rec: dict) -> str:
+    amount = ", ".join(line.strip() for line in (rec.get("amount") or "").splitlines() if line.strip())
+    return (
+        f"№{rec['request_id']} · {direction_label(rec.get('direction'))} · {amount} ₽ · "
+        f"курс {rec.get('rate')} · {rec.get('exchange')} · {rec.get('bank')} · {rec.get('contact')}"
+    )
+
+
+def render_matches(matches: list) -> str:
+    return "\n".join(["🔎 Подходящие встречные заявки:"] + [request_line(rec) for rec in matches])
+
+
 async def callback_cancel(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer("Заявка отменена")
     await callback.message.answer(
         "Заявка отменена. Чтобы создать новую — нажми «Создать новую заявку» или отправь /start.",
-        reply_markup=new_request_kb(),
+        reply_markup=NEW_REQUEST_KB,
     )
 
 
@@ -840,7 +4102,7 @@ async def callback_save_template(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.answer(
         "Введи название шаблона (например, «Bybit Т-Банк личка»):",
-        reply_markup=ReplyKeyboardRemove(),
+        reply_markup=REMOVE_KB,
     )
     await state.set_state(RequestStates.template_name)
 
@@ -850,7 +4112,7 @@ async def callback_no_template(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.answer(
         "Ок, шаблон не сохранён.",
-        reply_markup=new_request_kb(),
+        reply_markup=NEW_REQUEST_KB,
     )
 
 
@@ -872,25 +4134,863 @@ async def template_name_entered(message: types.Message, state: FSMContext):
         "conditions": data.get("conditions"),
     }
 
-    templates = get_user_templates(user_id)
-    templates.append(template)
-    save_user_templates(user_id, templates)
+    await templates_store.add(user_id, template)
 
     await message.answer(
         f"Шаблон «{name}» сохранён ✅\n\n"
         "В следующий раз можешь нажать «Использовать шаблон» при создании заявки.",
-        reply_markup=new_request_kb(),
+        reply_markup=NEW_REQUEST_KB,
     )
     await state.clear()
 
 
+# ---------- Мои заявки ----------
+
+STATUS_LABELS = {
+    "open": "🟢 активна",
+    "closed": "🔒 закрыта",
+    "expired": "⌛ истекла",
+}
+
+
+def my_requests_page(records: list, has_more: bool):
+    lines = []
+    for rec in records:
+        created = datetime.fromtimestamp(rec["created_at"]).strftime("%d.%m %H:%M")
+        amount = ", ".join(line.strip() for line in (rec.get("amount") or "").splitlines() if line.strip())
+        lines.append(
+            f"№{rec['request_id']} · {created} · {direction_label(rec.get('direction'))}\n"
+            f"   {amount} ₽ · курс {rec.get('rate')} · {rec.get('exchange')} · "
+            f"{STATUS_LABELS.get(rec.get('status'), rec.get('status'))}"
+        )
+    kb = None
+    if has_more:
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(
+                text="Ещё →",
+                callback_data=f"{MY_PAGE_PREFIX}{records[-1]['request_id']}",
+            )
+        ]])
+    return "\n\n".join(lines), kb
+
+
+async def cmd_my(message: types.Message, state: FSMContext):
+    records = await archive.by_author(message.from_user.id, limit=MY_PAGE_SIZE + 1)
+    if not records:
+        await message.answer("У тебя пока нет опубликованных заявок.")
+        return
+    text, kb = my_requests_page(records[:MY_PAGE_SIZE], len(records) > MY_PAGE_SIZE)
+    await message.answer(
+        "Твои последние заявки:\n\n" + text + "\n\n"
+        "Изменить активную заявку: /rate номер курс, /amount номер сумма, /close номер",
+        reply_markup=kb,
+    )
+
+
+async def my_page_callback(callback: CallbackQuery, state: FSMContext):
+    try:
+        before_id = int(callback.data[len(MY_PAGE_PREFIX):])
+    except ValueError:
+        await callback.answer()
+        return
+    records = await archive.by_author(callback.from_user.id, before_id, MY_PAGE_SIZE + 1)
+    await callback.answer()
+    if not records:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        return
+    text, kb = my_requests_page(records[:MY_PAGE_SIZE], len(records) > MY_PAGE_SIZE)
+    await callback.message.edit_text("Твои заявки:\n\n" + text, reply_markup=kb)
+
+
+# ---------- Поиск заявок ----------
+# /find сбер bybit 100к курс<84 — открытые заявки, где встречаются все слова
+# (можно начала слов), сумма пересекается с указанной, курс в заданных рамках.
+
+FIND_RATE_RE = re.compile(r"(?:курс|rate)\s*(<=|>=|≤|≥|<|>|=|:)\s*(\d+(?:[.,]\d+)?)", re.IGNORECASE)
+FIND_BOUND_RE = re.compile(r"^(<=|>=|≤|≥|<|>)(\d.*)$")
+FIND_HELP = (
+    "Формат: <code>/find слова [сумма] [курс&lt;84] [курс&gt;83]</code>\n"
+    "Сумма — число, диапазон или граница: <code>100к</code>, <code>100к-300к</code>, <code>&gt;=200к</code>\n"
+    "Например: <code>/find сбер bybit 100к</code>"
+)
+
+
+def split_find_query(raw: str):
+    """Отделяет от запроса курс и сумму: (остальные слова, [lo, hi] или None, rate_lo, rate_hi)."""
+    rate_lo = rate_hi = None
+    for op, value in FIND_RATE_RE.findall(raw):
+        value = float(value.replace(",", "."))
+        if op in ("<", "<=", "≤"):
+            rate_hi = value
+        elif op in (">", ">=", "≥"):
+            rate_lo = value
+        else:
+            rate_lo = rate_hi = value
+    rest, amount = [], None
+    for part in FIND_RATE_RE.sub(" ", raw).split():
+        bound = FIND_BOUND_RE.match(part)
+        if bound:
+            ranges = parse_amounts(bound.group(2))
+            if ranges:
+                lo, hi = amount or (0.0, float("inf"))
+                if bound.group(1) in ("<", "<=", "≤"):
+                    amount = [lo, ranges[0][1]]
+                else:
+                    amount = [ranges[0][0], hi]
+            continue
+        if part[0].isdigit():
+            ranges = parse_amounts(part)
+            if ranges:
+                amount = ranges[0]
+            continue
+        rest.append(part)
+    return rest, amount, rate_lo, rate_hi
+
+
+def parse_find_query(raw: str):
+    """«сбер bybit 100к курс<84» -> (["сбер", "bybit"], [100000, 100000], None, 84.0)"""
+    rest, amount, rate_lo, rate_hi = split_find_query(raw)
+    words = [word for part in rest for word in search_words(part)]
+    return words, amount, rate_lo, rate_hi
+
+
+async def cmd_find(message: types.Message, command: CommandObject):
+    words, amount, rate_lo, rate_hi = parse_find_query(command.args or "")
+    if not words and amount is None and rate_lo is None and rate_hi is None:
+        await message.answer(FIND_HELP, parse_mode=ParseMode.HTML)
+        return
+    total, found = search_index.search(words, amount, rate_lo, rate_hi)
+    metrics.inc("find_queries")
+    if not found:
+        await message.answer("Открытых заявок по такому запросу нет.")
+        return
+    more = f" (показаны {len(found)} самых свежих)" if total > len(found) else ""
+    await message.answer(
+        f"🔎 Найдено открытых заявок: {total}{more}\n\n" + "\n".join(request_line(rec) for rec in found)
+    )
+
+
+# ---------- Подписки ----------
+# /sub отправить bybit сбер >=200к курс<=84 — написать в личку, когда появится
+# такая заявка; /sub без слов — список подписок с кнопками удаления; /unsub номер.
+
+SUBSCRIBE_HELP = (
+    "Формат: <code>/sub [направление] [биржа] [банк] [сумма] [курс&lt;=84]</code>\n"
+    "Например: <code>/sub отправить bybit &gt;=200к курс&lt;=84</code>\n"
+    "Чего нет в подписке — подходит любое. Удалить: <code>/unsub номер</code>"
+)
+# слова, которые в подписке ничего не значат
+SUBSCRIBE_NOISE = frozenset(("rub", "руб", "рубли", "только"))
+
+
+def subscription_vocabulary() -> dict:
+    """Поле -> {значение: варианты написания} из кнопок сценария заявки."""
+    vocabulary = {
+        "direction": {
+            DIRECTION_RECEIVE: ("принять", "приму", "получить", "покупка"),
+            DIRECTION_SEND: ("отправить", "отправлю", "отдать", "продажа"),
+        },
+    }
+    for step in FLOW:
+        if step["field"] not in ("exchange", "bank"):
+            continue
+        values = vocabulary.setdefault(step["field"], {})
+        for rows in step["options"].values():
+            for row in rows:
+                for value in row:
+                    text = value.lower().replace("ё", "е")
+                    values[value] = (text, text.removeprefix("только "))
+    return vocabulary
+
+
+SUBSCRIPTION_VOCABULARY = subscription_vocabulary()
+
+
+def parse_subscription(raw: str):
+    """Критерии подписки из текста; ValueError с непонятым словом, если разобрать не удалось."""
+    rest, amount, rate_lo, rate_hi = split_find_query(raw)
+    criteria = {"direction": None, "exchange": None, "bank": None}
+    for word in rest:
+        word = word.lower().replace("ё", "е")
+        if word in SUBSCRIBE_NOISE:
+            continue
+        exact, prefix = [], []
+        for field, values in SUBSCRIPTION_VOCABULARY.items():
+            for value, spellings in values.items():
+                if word in spellings:
+                    exact.append((field, value))
+                elif len(word) >= 3 and any(s.startswith(word) for s in spellings):
+                    prefix.append((field, value))
+        matched = exact or prefix
+        if len(matched) != 1:
+            raise ValueError(word)
+        field, value = matched[0]
+        criteria[field] = value
+    lo, hi = amount or (0.0, float("inf"))
+    criteria.update(amount_lo=lo, amount_hi=hi, rate_lo=rate_lo, rate_hi=rate_hi)
+    return criteria
+
+
+def describe_subscription(sub: dict) -> str:
+    parts = [direction_label(sub["direction"]) if sub["direction"] else "любое направление"]
+    parts.append(sub["exchange"] or "любая биржа")
+    parts.append(sub["bank"] or "любой банк")
+    lo, hi = sub["amount_lo"], sub["amount_hi"]
+    if lo == hi:
+        parts.append(format_rub(lo))
+    elif lo > 0 and hi != float("inf"):
+        parts.append(f"{format_rub(lo)} – {format_rub(hi)}")
+    elif lo > 0:
+        parts.append(f"от {format_rub(lo)}")
+    elif hi != float("inf"):
+        parts.append(f"до {format_rub(hi)}")
+    if sub["rate_lo"] is not None and sub["rate_lo"] == sub["rate_hi"]:
+        parts.append(f"курс {sub['rate_lo']:g}")
+    else:
+        if sub["rate_lo"] is not None:
+            parts.append(f"курс ≥ {sub['rate_lo']:g}")
+        if sub["rate_hi"] is not None:
+            parts.append(f"курс ≤ {sub['rate_hi']:g}")
+    return f"№{sub['id']}: " + " · ".join(parts)
+
+
+def subscriptions_page(user_id: int):
+    subs = subscriptions.by_user(user_id)
+    if not subs:
+        return "Подписок пока нет.\n\n" + SUBSCRIBE_HELP, None
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"❌ Удалить №{sub['id']}", callback_data=f"{UNSUBSCRIBE_PREFIX}{sub['id']}")]
+        for sub in subs
+    ])
+    return "🔔 Твои подписки:\n\n" + "\n".join(describe_subscription(sub) for sub in subs), kb
+
+
+async def cmd_subscribe(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id
+    if not (command.args or "").strip():
+        text, kb = subscriptions_page(user_id)
+        await message.answer(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+        return
+    try:
+        criteria = parse_subscription(command.args)
+    except ValueError as e:
+        await message.answer(f"Не понял «{e}».\n\n" + SUBSCRIBE_HELP, parse_mode=ParseMode.HTML)
+        return
+    if len(subscriptions.by_user(user_id)) >= SUBSCRIPTIONS_PER_USER:
+        await message.answer(
+            f"Можно не больше {SUBSCRIPTIONS_PER_USER} подписок. Удали ненужные: /sub"
+        )
+        return
+    sub = await subscriptions.add(user_id, criteria)
+    metrics.inc("subscription_added")
+    await message.answer(f"🔔 Подписка сохранена.\n{describe_subscription(sub)}")
+
+
+async def cmd_unsubscribe(message: types.Message, command: CommandObject):
+    sub_ids = [int(x) for x in (command.args or "").replace(",", " ").split() if x.isdigit()]
+    if not sub_ids:
+        await message.answer("Формат: /unsub номер (номера подписок — в /sub)")
+        return
+    removed = await subscriptions.remove(message.from_user.id, sub_ids)
+    if removed:
+        await message.answer(f"Подписок удалено: {removed}.")
+    else:
+        await message.answer("Таких подписок у тебя нет.")
+
+
+async def unsubscribe_callback(callback: CallbackQuery):
+    try:
+        sub_id = int(callback.data[len(UNSUBSCRIBE_PREFIX):])
+    except ValueError:
+        await callback.answer()
+        return
+    removed = await subscriptions.remove(callback.from_user.id, [sub_id])
+    await callback.answer("Подписка удалена" if removed else "Подписка уже удалена")
+    text, kb = subscriptions_page(callback.from_user.id)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+
+
+async def notification_unsubscribe_callback(callback: CallbackQuery):
+    # под уведомлением: сам текст заявки оставляем, убираем только кнопку
+    try:
+        sub_id = int(callback.data[len(NOTIFY_UNSUBSCRIBE_PREFIX):])
+    except ValueError:
+        await callback.answer()
+        return
+    removed = await subscriptions.remove(callback.from_user.id, [sub_id])
+    await callback.answer("Подписка удалена. Остальные — /sub" if removed else "Подписка уже удалена")
+    await callback.message.edit_reply_markup(reply_markup=None)
+
+
+# ---------- Inline-режим: быстрая заявка из шаблона ----------
+# «@бот 150000 83,15» в любом чате — список шаблонов с этими суммой и курсом
+# (чего не указано — берётся из последней заявки), кнопка под результатом
+# публикует заявку. Inline-режим нужно включить у @BotFather (/setinline).
+
+class InlineResultsCache:
+    """Готовые inline-результаты: user_id -> {текст запроса: результаты}, LRU по пользователям."""
+
+    def __init__(self, max_users: int = 10000, per_user: int = 20):
+        self.max_users = max_users
+        self.per_user = per_user
+        self._users = OrderedDict()
+
+    def get(self, user_id: int, query: str):
+        queries = self._users.get(user_id)
+        if queries is None:
+            return None
+        self._users.move_to_end(user_id)
+        return queries.get(query)
+
+    def put(self, user_id: int, query: str, results: list):
+        queries = self._users.setdefault(user_id, OrderedDict())
+        self._users.move_to_end(user_id)
+        queries[query] = results
+        while len(queries) > self.per_user:
+            queries.popitem(last=False)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._users.pop(int(user_id), None)
+
+
+inline_cache = InlineResultsCache()
+templates_store.listeners.append(inline_cache.invalidate)
+
+
+QUICK_RATE_MARKER_RE = re.compile(r"(?:курс|rate)\s*[:=]?\s*", re.IGNORECASE)
+# число без «к» и диапазона меньше этого — курс, а не сумма
+QUICK_RATE_MAX = 1000
+
+
+def parse_quick_query(query: str):
+    """
+    «100000-300000 83,15» -> ("100000-300000", "83,15"); чего нет — None.
+    Курс можно пометить явно: «курс 84». Без пометки число отличаем от суммы
+    по величине; если на место претендуют два значения, оно тоже None —
+    тогда берётся значение из последней заявки, а не угадывается.
+    """
+    amounts, rates = [], []
+    for token in QUICK_RATE_MARKER_RE.sub("курс=", query).split():
+        if token.lower().startswith("курс="):
+            if parse_rate(token[5:]) is not None:
+                rates.append(token[5:])
+        elif RATE_RE.fullmatch(token) and (parse_number(token) or 0) < QUICK_RATE_MAX:
+            if parse_rate(token) is not None:
+                rates.append(token)
+        elif parse_amounts(token):
+            amounts.append(token)
+    amount = amounts[0] if len(amounts) == 1 else None
+    rate = rates[0] if len(rates) == 1 else None
+    return amount, rate
+
+
+async def build_inline_results(user: types.User, query: str) -> list:
+    # в выдачу inline-запроса Telegram принимает не больше 50 результатов
+    templates = templates_store.page(user.id, 0, 50)
+    if not templates:
+        return []
+    amount, rate = parse_quick_query(query)
+    if amount is None or rate is None:
+        last = await archive.by_author(user.id, limit=1)
+        if last:
+            lines = [line.strip() for line in (last[0].get("amount") or "").splitlines() if line.strip()]
+            amount = amount or (lines[0].replace(" ", "") if lines else None)
+            rate = rate or last[0].get("rate")
+    if amount is None or rate is None:
+        return []
+
+    results = []
+    for tpl in templates:
+        # автор в данных кнопки: нажать её может любой, кто видит сообщение
+        callback_data = f"{QUICK_PUBLISH_PREFIX}{to_base36(user.id)}:{tpl['id']}:{amount}:{rate}"
+        if len(callback_data.encode()) > 64:
+            continue
+        data = dict(tpl, amount=amount, rate=rate, request_id="—",
+                    author=user.mention_html(), contact=f"@{user.username}")
+        results.append(InlineQueryResultArticle(
+            id=tpl["id"],
+            title=tpl.get("name") or f"Шаблон {tpl['id']}",
+            description=(
+                f"{direction_label(tpl.get('direction'))} · {amount} ₽ · курс {rate} · "
+                f"{tpl.get('exchange')} · {tpl.get('bank')}"
+            ),
+            input_message_content=InputTextMessageContent(
+                message_text=render_request(data), parse_mode=ParseMode.HTML
+            ),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="📤 Опубликовать", callback_data=callback_data)
+            ]]),
+        ))
+    return results
+
+
+async def inline_templates(inline_query: InlineQuery):
+    user = inline_query.from_user
+    if not user.username:
+        await inline_query.answer(
+            [], cache_time=INLINE_CACHE_TIME, is_personal=True,
+            button=InlineQueryResultsButton(text="Нужен @username — создай заявку в боте", start_parameter="new"),
+        )
+        return
+    query = " ".join(inline_query.query.split())
+    results = inline_cache.get(user.id, query)
+    if results is None:
+        results = await build_inline_results(user, query)
+        inline_cache.put(user.id, query, results)
+        metrics.inc("inline_cache_miss")
+    else:
+        metrics.inc("inline_cache_hit")
+    button = None
+    if not results:
+        button = InlineQueryResultsButton(text="Укажи сумму и курс или создай шаблон", start_parameter="new")
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, button=button)
+
+
+async def quick_publish_callback(callback: CallbackQuery, bot: Bot):
+    user = callback.from_user
+    try:
+        author, template_id, amount, rate = callback.data[len(QUICK_PUBLISH_PREFIX):].split(":", 3)
+        author_id = int(author, 36)
+    except ValueError:
+        await callback.answer("Кнопка устарела — создай заявку заново.", show_alert=True)
+        return
+    if author_id != user.id:
+        await callback.answer("Опубликовать заявку может только её автор.", show_alert=True)
+        return
+    key = f"inline:{callback.inline_message_id or callback.id}"
+    published = publish_marks.cache.get(key)
+    if published is not None:
+        await callback.answer(f"Заявка №{published} уже опубликована.")
+        return
+    tpl = templates_store.find(user.id, template_id)
+    if tpl is None:
+        await callback.answer("Шаблон не найден", show_alert=True)
+        return
+    if not user.username or parse_rate(rate) is None or not parse_amounts(amount):
+        await callback.answer("Не получилось собрать заявку — создай её через бота.", show_alert=True)
+        return
+    # маршруты зависят только от полей шаблона
+    destinations = routes.destinations(tpl)
+    if not destinations:
+        metrics.inc("publish_unrouted")
+        await callback.answer("Для такой заявки не задан чат — она не опубликована.", show_alert=True)
+        return
+
+    request_id = await get_next_request_id()
+    published = await publish_marks.claim(key, request_id)
+    if published is not None:
+        metrics.inc("publish_duplicate")
+        await callback.answer(f"Заявка №{published} уже опубликована.")
+        return
+    data = dict(
+        tpl,
+        amount=amount,
+        amount_ranges=parse_amounts(amount),
+        rate=rate,
+        rate_value=str(parse_rate(rate)),
+        contact=f"@{user.username}",
+        request_id=request_id,
+        author=user.mention_html(),
+    )
+    record = request_record(data, user.id)
+    text_out = render_request(record)
+    try:
+        matches, positions = await publish_record(record, destinations, text_out, user.id)
+    except Exception:
+        await publish_failed(callback, key)
+        raise
+    metrics.inc("quick_published")
+
+    status = f"✅ Заявка №{request_id} поставлена в очередь на публикацию {publish_targets_note(positions)}."
+    await callback.answer(status)
+    try:
+        if callback.inline_message_id:
+            await bot.edit_message_text(
+                text=f"{text_out}\n{status}",
+                inline_message_id=callback.inline_message_id,
+                parse_mode=ParseMode.HTML,
+            )
+        if matches:
+            await bot.send_message(user.id, render_matches(matches))
+    except TelegramAPIError:
+        pass
+
+
+# ---------- Админ: экспорт и импорт ----------
+# /export requests|templates [jsonl|csv] — файл пишется построчно во временный
+# файл в отдельном потоке и отправляется документом. /import requests|templates —
+# подписью к файлу .jsonl или .csv; строки проверяются и пишутся пачками.
+
+EXPORT_KINDS = ("requests", "templates")
+EXPORT_FORMATS = ("jsonl", "csv")
+REQUEST_CSV_FIELDS = tuple(name for name in REQUEST_FIELDS if name != "amount_ranges") + ("status",)
+TEMPLATE_CSV_FIELDS = ("user_id", "name", "direction", "bank", "traffic", "exchange", "conditions")
+
+
+def iter_request_rows(path: str):
+    """Все заявки архива по одной; своё соединение, чтобы не занимать поток базы."""
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.execute("SELECT status, payload FROM requests ORDER BY request_id")
+        for status, payload in cursor:
+            record = json.loads(payload)
+            record["status"] = status
+            yield record
+    finally:
+        conn.close()
+
+
+def iter_template_rows(store: TemplateStore):
+    # файл читается при первой строке — уже в потоке write_export
+    for user_id, templates in store.read_file().items():
+        for tpl in templates:
+            yield dict(tpl, user_id=int(user_id))
+
+
+def write_export(rows, fmt: str, fields: tuple) -> str:
+    """Пишет строки во временный файл и возвращает путь к нему."""
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=f".{fmt}")
+    with open(fd, "w", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return path
+
+
+def read_import_rows(path: str, fmt: str):
+    """(номер строки, dict) или (номер строки, None), если строку не удалось разобрать."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield lineno, row if isinstance(row, dict) else None
+
+
+def validate_request_row(row: dict) -> dict:
+    """Строка импорта -> заявка архива; ValueError, если строка негодная."""
+    record = {name: row.get(name) or None for name in REQUEST_FIELDS}
+    record["request_id"] = int(row["request_id"])
+    record["author_id"] = int(row["author_id"])
+    record["created_at"] = float(row.get("created_at") or time.time())
+    if record["direction"] not in DIRECTIONS:
+        raise ValueError("direction")
+    status = row.get("status") or "open"
+    if status not in STATUS_LABELS:
+        raise ValueError("status")
+    record["status"] = status
+    rate = parse_rate(record["rate"] or "")
+    if rate is None:
+        raise ValueError("rate")
+    record["rate_value"] = str(rate)
+    record["amount_ranges"] = parse_amounts(record["amount"] or "")
+    if not record["amount_ranges"]:
+        raise ValueError("amount")
+    return record
+
+
+def validate_template_row(row: dict):
+    user_id = int(row["user_id"])
+    template = {name: row.get(name) or None for name in TEMPLATE_CSV_FIELDS[1:]}
+    if not template["name"] or template["direction"] not in DIRECTIONS:
+        raise ValueError("template")
+    return user_id, template
+
+
+async def import_template(user_id: int, template: dict):
+    """
+    Шаблон из импорта — в хранилище шарда, которому принадлежит пользователь:
+    у остальных шардов его шаблоны в памяти устаревшие, и их запись затёрла бы импорт.
+    """
+    owner = user_id % SHARDS
+    if owner != SHARD_INDEX:
+        shard_inboxes[owner].put(("template", (user_id, template)))
+        return
+    existing = [{k: v for k, v in tpl.items() if k != "id"} for tpl in templates_store.get(user_id)]
+    if template not in existing:
+        await templates_store.add(user_id, template)
+
+
+async def cmd_export(message: types.Message, command: CommandObject, bot: Bot):
+    args = (command.args or "").split()
+    kind = args[0] if args else ""
+    fmt = args[1] if len(args) > 1 else "jsonl"
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        await message.answer("Формат: /export requests|templates [jsonl|csv]")
+        return
+
+    if kind == "requests":
+        rows, fields = iter_request_rows(db.path), REQUEST_CSV_FIELDS
+    else:
+        # свои несохранённые изменения — сначала на диск, остальные шарды пишут сами
+        await templates_store.flush()
+        rows, fields = iter_template_rows(templates_store), TEMPLATE_CSV_FIELDS
+    path = await asyncio.to_thread(write_export, rows, fmt, fields)
+    try:
+        filename = f"{kind}-{datetime.now():%Y%m%d-%H%M}.{fmt}"
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=filename))
+    finally:
+        os.unlink(path)
+    metrics.inc(f"export_{kind}")
+
+
+async def cmd_import(message: types.Message, command: CommandObject, bot: Bot):
+    kind = (command.args or "").strip()
+    document = message.document
+    fmt = Path(document.file_name or "").suffix.lstrip(".") if document else ""
+    fmt = "jsonl" if fmt == "json" else fmt
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        await message.answer("Пришли файл .jsonl или .csv с подписью /import requests или /import templates")
+        return
+
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=f".{fmt}")
+    os.close(fd)
+    imported = skipped = 0
+    # номера негодных строк — только первые, чтобы память не росла с файлом
+    bad_lines = []
+
+    def reject(lineno: int):
+        nonlocal skipped
+        skipped += 1
+        if len(bad_lines) < IMPORT_BAD_SHOWN:
+            bad_lines.append(lineno)
+
+    try:
+        await bot.download(document, destination=path)
+        rows = read_import_rows(path, fmt)
+        while True:
+            chunk = await asyncio.to_thread(lambda: list(islice(rows, IMPORT_CHUNK)))
+            if not chunk:
+                break
+            records, lines = [], {}
+            for lineno, row in chunk:
+                if row is None:
+                    reject(lineno)
+                    continue
+                try:
+                    if kind == "requests":
+                        record = validate_request_row(row)
+                        if record["request_id"] in lines:
+                            raise ValueError("request_id")
+                        records.append(record)
+                        lines[record["request_id"]] = lineno
+                    else:
+                        await import_template(*validate_template_row(row))
+                        imported += 1
+                except (KeyError, TypeError, ValueError):
+                    reject(lineno)
+            if records:
+                # сначала поднимаем общий счётчик, чтобы шарды не выдали эти номера заново
+                floor = max(r["request_id"] for r in records)
+                await request_ids.advance(floor)
+                for peer in shard_peers:
+                    peer.put(("advance", floor))
+                taken = await archive.add_many(records)
+                for record in taken:
+                    reject(lines[record["request_id"]])
+                taken_ids = {r["request_id"] for r in taken}
+                for record in records:
+                    if record["request_id"] in taken_ids:
+                        continue
+                    if record["status"] == "open":
+                        open_request(record)
+                        await schedule_request_timers(record["request_id"], record["created_at"])
+                    imported += 1
+    finally:
+        os.unlink(path)
+
+    metrics.inc(f"import_{kind}", imported)
+    report = f"Импорт {kind}: загружено {imported}, пропущено {skipped}."
+    if bad_lines:
+        more = "…" if skipped > len(bad_lines) else ""
+        report += "\nНегодные строки (или номер уже занят): " + ", ".join(map(str, bad_lines)) + more
+    await message.answer(report)
+
+
+# ---------- Админ: статистика ----------
+# /stats [дней] — заявки за последние дни (по умолчанию только сегодня) по
+# направлениям, банкам, биржам и источникам; /stats rebuild — пересчёт по архиву.
+
+STATS_LABELS = {
+    "direction": "Направление",
+    "bank": "Банк",
+    "exchange": "Биржа",
+    "traffic": "Источник трафика",
+}
+STATS_TOP = 10
+
+
+def format_rub(amount: float) -> str:
+    return f"{amount:,.0f}".replace(",", " ") + " ₽"
+
+
+def render_stats(summary: dict, days: int) -> str:
+    dimensions = summary["dimensions"]
+    total = dimensions.get("total", [("", 0, 0.0)])[0]
+    period = "сегодня" if days == 1 else f"за {days} дн."
+    lines = [f"📊 Заявки {period}: {total[1]} шт., {format_rub(total[2])}"]
+    if days > 1 and summary["days"]:
+        lines.append("По дням: " + " · ".join(
+            f"{datetime.fromtimestamp(start):%d.%m} — {requests}" for start, requests in summary["days"]
+        ))
+    if summary["hours"]:
+        lines.append("Сегодня по часам: " + " · ".join(
+            f"{datetime.fromtimestamp(start):%H}ч — {requests}" for start, requests in summary["hours"]
+        ))
+    for dimension in STATS_DIMENSIONS:
+        values = dimensions.get(dimension)
+        if not values:
+            continue
+        lines.append("")
+        lines.append(f"{STATS_LABELS[dimension]}:")
+        for value, requests, amount in values[:STATS_TOP]:
+            label = direction_label(value) if value in DIRECTIONS else value
+            lines.append(f"  {label} — {requests} ({format_rub(amount)})")
+        if len(values) > STATS_TOP:
+            lines.append(f"  … и ещё {len(values) - STATS_TOP}")
+    return "\n".join(lines)
+
+
+async def cmd_stats(message: types.Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if arg == "rebuild":
+        count = await stats.rebuild()
+        await message.answer(f"Статистика пересчитана по архиву, заявок: {count}.")
+        return
+    if arg and not (arg.isdigit() and 1 <= int(arg) <= 366):
+        await message.answer("Формат: /stats [дней] или /stats rebuild")
+        return
+    days = int(arg or 1)
+    since = (datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)).timestamp()
+    summary = await stats.summary(since)
+    await message.answer(render_stats(summary, days))
+
+
+# ---------- Правка и закрытие опубликованных заявок ----------
+
+def close_request_kb(request_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(
+            text="🔒 Закрыть заявку",
+            callback_data=f"{CLOSE_REQUEST_PREFIX}{request_id}",
+        )
+    ]])
+
+
+async def own_open_request(message: types.Message, raw_id) -> dict:
+    """Открытая заявка автора по номеру; иначе отвечаем пользователю и возвращаем None."""
+    try:
+        request_id = int(str(raw_id).lstrip("№"))
+    except (TypeError, ValueError):
+        await message.answer("Укажи номер заявки, например: <code>/close 123</code>", parse_mode=ParseMode.HTML)
+        return None
+    record = await archive.get(request_id)
+    if record is None or record.get("author_id") != message.chat.id:
+        await message.answer(f"Заявка №{request_id} не найдена среди твоих.")
+        return None
+    if record.get("status") != "open":
+        await message.answer(
+            f"Заявка №{request_id} уже {STATUS_LABELS.get(record['status'], record['status'])}."
+        )
+        return None
+    return record
+
+
+async def close_own_request(message: types.Message, bot: Bot, raw_id):
+    record = await own_open_request(message, raw_id)
+    if record is None:
+        return
+    request_id = record["request_id"]
+    await archive.set_status(request_id, "closed")
+    close_request(request_id)
+    await scheduler.cancel(request_id)
+    await rewrite_posts(bot, request_id, render_request(record) + CLOSED_MARK)
+    await posts.remove(request_id)
+    metrics.inc("request_closed")
+    await message.answer(f"🔒 Заявка №{request_id} закрыта.", reply_markup=NEW_REQUEST_KB)
+
+
+async def update_own_request(message: types.Message, bot: Bot, record: dict, changes: dict, what: str):
+    """Меняем поля заявки в архиве и индексах и правим её посты на месте."""
+    request_id = record["request_id"]
+    record.update(changes)
+    await archive.replace(record)
+    close_request(request_id)
+    open_request(record)
+
+    text = render_request(record)
+    edited = await rewrite_posts(bot, request_id, text)
+    for post in await posts.get(request_id):
+        post["text"] = text
+        await posts.add(post)
+    metrics.inc("request_edited")
+    note = " Пост в чате обновлён." if edited else ""
+    await message.answer(f"✏️ Заявка №{request_id}: {what}.{note}")
+
+
+async def cmd_close(message: types.Message, command: CommandObject, bot: Bot):
+    await close_own_request(message, bot, command.args)
+
+
+async def close_request_callback(callback: CallbackQuery, bot: Bot):
+    await callback.answer()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await close_own_request(callback.message, bot, callback.data[len(CLOSE_REQUEST_PREFIX):])
+
+
+async def cmd_rate(message: types.Message, command: CommandObject, bot: Bot):
+    raw_id, _, value = (command.args or "").strip().partition(" ")
+    value = value.strip()
+    rate = parse_rate(value) if value else None
+    if rate is None:
+        await message.answer(
+            "Формат: <code>/rate номер курс</code>, например <code>/rate 123 83,40</code>",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+    record = await own_open_request(message, raw_id)
+    if record is None:
+        return
+    await update_own_request(message, bot, record, {"rate": value, "rate_value": str(rate)}, "курс обновлён")
+
+
+async def cmd_amount(message: types.Message, command: CommandObject, bot: Bot):
+    raw_id, _, value = (command.args or "").strip().partition(" ")
+    value = "\n".join(line.strip() for line in value.strip().splitlines() if line.strip())
+    ranges = parse_amounts(value) if value else []
+    if not ranges:
+        await message.answer(
+            "Формат: <code>/amount номер сумма</code>, например <code>/amount 123 100000-300000</code>",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+    record = await own_open_request(message, raw_id)
+    if record is None:
+        return
+    await update_own_request(message, bot, record, {"amount": value, "amount_ranges": ranges}, "сумма обновлена")
+
+
 # ---------- Системные команды ----------
 
 async def cmd_cancel(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer(
         "Ок, заявка отменена. Чтобы создать новую — отправь /start.",
-        reply_markup=ReplyKeyboardRemove(),
+        reply_markup=REMOVE_KB,
     )
 
 
@@ -898,12 +4998,46 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
 # MAIN
 # ==========================
 
-async def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("Не задан BOT_TOKEN в переменных окружения.")
-
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
+async def on_startup(bot: Bot):
+    if not any(isinstance(m, ApiMetricsMiddleware) for m in bot.session.middleware):
+        bot.session.middleware(ApiMetricsMiddleware(metrics))
+    templates_store.load()
+    await load_open_requests()
+    await subscriptions.load()
+    await publish_queue.start(bot)
+    notifier.start(bot)
+    await scheduler.start(bot)
+    # табло одно на чат — его ведёт только нулевой шард
+    if BOARD_ENABLED and TARGET_CHAT_ID and SHARD_INDEX == 0:
+        await board.start(bot, TARGET_CHAT_ID)
+    await metrics_server.start()
+
+
+async def on_shutdown():
+    await metrics_server.close()
+    await board.close()
+    await stats.close()
+    await notifier.close()
+    await scheduler.close()
+    await publish_queue.close()
+    await templates_store.close()
+    await db.close()
+
+
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=SQLiteStorage(db, FSM_TTL, FSM_CACHE_SIZE, FSM_SWEEP_INTERVAL))
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    # повторные апдейты и сверх личных лимитов отсекаются первыми; полосы ставим перед FSM-middleware:
+    # состояние пользователя должно читаться уже после того, как подошла очередь его апдейта
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(update_dedup)
+    dp.update.outer_middleware(user_throttle)
+    dp.update.outer_middleware(update_lanes)
+    dp.update.outer_middleware(dp.fsm)
+    dp.message.middleware(MetricsMiddleware(metrics))
+    dp.callback_query.middleware(MetricsMiddleware(metrics))
+    dp.inline_query.middleware(MetricsMiddleware(metrics))
 
     # Команды (только в личке)
     dp.message.register(cmd_start, CommandStart(), F.chat.type == ChatType.PRIVATE)
@@ -912,6 +5046,13 @@ async def main():
         Command(commands=["cancel", "отмена"]),
         F.chat.type == ChatType.PRIVATE,
     )
+    dp.message.register(cmd_my, Command("my"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_find, Command("find"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_subscribe, Command("sub"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_unsubscribe, Command("unsub"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_close, Command("close"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_rate, Command("rate"), F.chat.type == ChatType.PRIVATE)
+    dp.message.register(cmd_amount, Command("amount"), F.chat.type == ChatType.PRIVATE)
 
     # Кнопка "Создать новую заявку"
     dp.message.register(
@@ -950,13 +5091,7 @@ async def main():
     dp.message.register(direction_chosen, RequestStates.direction, F.chat.type == ChatType.PRIVATE)
     dp.message.register(amount_chosen, RequestStates.amount, F.chat.type == ChatType.PRIVATE)
     dp.message.register(rate_chosen, RequestStates.rate, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(bank_chosen, RequestStates.bank, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(bank_custom_entered, RequestStates.bank_custom, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(traffic_chosen, RequestStates.traffic, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(traffic_custom_entered, RequestStates.traffic_custom, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(exchange_chosen, RequestStates.exchange, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(conditions_chosen, RequestStates.conditions, F.chat.type == ChatType.PRIVATE)
-    dp.message.register(conditions_custom_entered, RequestStates.conditions_custom, F.chat.type == ChatType.PRIVATE)
+    register_flow(dp)
     dp.message.register(contact_chosen, RequestStates.contact, F.chat.type == ChatType.PRIVATE)
     dp.message.register(template_name_entered, RequestStates.template_name, F.chat.type == ChatType.PRIVATE)
 
@@ -970,8 +5105,272 @@ async def main():
         delete_template_callback,
         F.data.startswith(DELETE_TEMPLATE_PREFIX),
     )
+    dp.callback_query.register(template_page_callback, F.data.startswith(TEMPLATE_PAGE_PREFIX))
+    dp.callback_query.register(legacy_template_callback, F.data.startswith(LEGACY_TEMPLATE_PREFIXES))
+    dp.callback_query.register(my_page_callback, F.data.startswith(MY_PAGE_PREFIX))
+    dp.callback_query.register(close_request_callback, F.data.startswith(CLOSE_REQUEST_PREFIX))
+    dp.callback_query.register(unsubscribe_callback, F.data.startswith(UNSUBSCRIBE_PREFIX))
+    dp.callback_query.register(notification_unsubscribe_callback, F.data.startswith(NOTIFY_UNSUBSCRIBE_PREFIX))
+
+    # Админские команды
+    dp.message.register(cmd_export, Command("export"), F.from_user.id.in_(ADMIN_IDS))
+    dp.message.register(cmd_import, Command("import"), F.document, F.from_user.id.in_(ADMIN_IDS))
+    dp.message.register(cmd_stats, Command("stats"), F.from_user.id.in_(ADMIN_IDS))
+
+    # Inline-режим: быстрые заявки из шаблонов
+    dp.inline_query.register(inline_templates)
+    dp.callback_query.register(quick_publish_callback, F.data.startswith(QUICK_PUBLISH_PREFIX))
+
+    return dp
+
+
+# ---------- Webhook ----------
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def build_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """
+    aiohttp-приложение для режима webhook. Обновления принимаются на WEBHOOK_PATH
+    (с проверкой заголовка X-Telegram-Bot-Api-Secret-Token, если задан
+    WEBHOOK_SECRET), /health отвечает для балансировщика.
+    """
+    app = web.Application()
+    app.router.add_get("/health", health)
+
+    async def register_webhook(app: web.Application):
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    async def unregister_webhook(app: web.Application):
+        await bot.delete_webhook()
+
+    # снимаем вебхук до того, как закроется сессия бота
+    if WEBHOOK_URL:
+        app.on_shutdown.append(unregister_webhook)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    # регистрируем вебхук, когда диспетчер уже запущен
+    if WEBHOOK_URL:
+        app.on_startup.append(register_webhook)
+    return app
+
+
+async def wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def serve_app(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    try:
+        await wait_for_signal()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    await serve_app(build_webhook_app(bot, dp))
+
+
+# ---------- Шарды ----------
+
+def shard_of(raw: dict) -> int:
+    """Шард апдейта по id пользователя (или чата), от которого он пришёл."""
+    for value in raw.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat") or {}
+            return int(user.get("id", 0)) % SHARDS
+    return 0
+
+
+def shard_main(index: int, inboxes: list):
+    """Точка входа процесса-воркера."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard(index, inboxes))
+
 
-    await dp.start_polling(bot)
+async def run_shard(index: int, inboxes: list):
+    """
+    Воркер: обрабатывает апдейты своих пользователей из inboxes[index]
+    и применяет изменения индексов, присланные другими шардами.
+    """
+    global SHARD_INDEX, shard_peers, shard_inboxes
+    SHARD_INDEX = index
+    shard_inboxes = inboxes
+    shard_peers = [inbox for i, inbox in enumerate(inboxes) if i != index]
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + index
+
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+    await dp.emit_startup(bot=bot)
+    loop = asyncio.get_running_loop()
+    inbox = inboxes[index]
+    tasks = set()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:
+                break
+            kind, payload = item
+            if kind == "update":
+                task = asyncio.create_task(dp.feed_raw_update(bot, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif kind == "open":
+                open_request(payload, broadcast=False)
+            elif kind == "close":
+                close_request(payload, broadcast=False)
+            elif kind == "advance":
+                request_ids.forget_below(payload)
+            elif kind == "template":
+                task = asyncio.create_task(import_template(*payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif kind == "subscribe":
+                subscriptions.index(payload)
+            elif kind == "unsubscribe":
+                subscriptions.unindex(payload)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+async def poll_updates(bot: Bot, route, allowed_updates: list):
+    """Long polling во фронте: апдейты не обрабатываются, а раздаются шардам."""
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except (TelegramNetworkError, TelegramServerError):
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            route(update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+
+
+def build_front_app(bot: Bot, route, allowed_updates: list) -> web.Application:
+    """Вебхук фронта: проверяет секрет и сразу отдаёт апдейт шарду."""
+    app = web.Application()
+    app.router.add_get("/health", health)
+
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401, text="Unauthorized")
+        route(await request.json())
+        return web.Response()
+
+    async def register_webhook(app: web.Application):
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=allowed_updates,
+        )
+
+    async def unregister_webhook(app: web.Application):
+        await bot.delete_webhook()
+
+    app.router.add_post(WEBHOOK_PATH, receive)
+    if WEBHOOK_URL:
+        app.on_startup.append(register_webhook)
+        app.on_shutdown.append(unregister_webhook)
+    return app
+
+
+async def serve_polling_front(bot: Bot, route, allowed_updates: list):
+    polling = asyncio.create_task(poll_updates(bot, route, allowed_updates))
+    try:
+        await wait_for_signal()
+    finally:
+        polling.cancel()
+
+
+async def watch_workers(workers: list):
+    """Ждёт, пока завершится любой из воркеров, и возвращает его."""
+    by_sentinel = {worker.sentinel: worker for worker in workers}
+    ready = await asyncio.to_thread(multiprocessing.connection.wait, list(by_sentinel))
+    return by_sentinel[ready[0]]
+
+
+async def run_sharded(bot: Bot, dp: Dispatcher):
+    """
+    Фронт + SHARDS воркеров. Номера заявок (counter.json) и шаблоны
+    (templates.json) согласуются через flock, остальное — общая SQLite в WAL.
+    Если воркер умер, фронт останавливается целиком и завершается с ошибкой:
+    иначе апдейты его пользователей копились бы в очереди без ответа,
+    а перезапуск всего бота оставляем внешнему супервизору (systemd, docker).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(SHARDS)]
+    workers = [
+        ctx.Process(target=shard_main, args=(index, inboxes), name=f"shard-{index}")
+        for index in range(SHARDS)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def route(raw: dict):
+        inboxes[shard_of(raw)].put(("update", raw))
+
+    allowed_updates = dp.resolve_used_update_types()
+    if WEBHOOK_URL:
+        front = asyncio.create_task(serve_app(build_front_app(bot, route, allowed_updates)))
+    else:
+        front = asyncio.create_task(serve_polling_front(bot, route, allowed_updates))
+    watcher = asyncio.create_task(watch_workers(workers))
+    dead = None
+    try:
+        done, _ = await asyncio.wait({front, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if watcher in done:
+            dead = watcher.result()
+    finally:
+        front.cancel()
+        await asyncio.gather(front, return_exceptions=True)
+        for worker, inbox in zip(workers, inboxes):
+            if worker.is_alive():
+                inbox.put(None)
+            else:
+                # очередь мёртвого воркера никто не дочитает — не ждём её при выходе
+                inbox.cancel_join_thread()
+        for worker in workers:
+            await asyncio.to_thread(worker.join, 30)
+        await bot.session.close()
+    if dead is not None:
+        raise RuntimeError(f"Воркер {dead.name} завершился с кодом {dead.exitcode}, фронт остановлен")
+
+
+async def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("Не задан BOT_TOKEN в переменных окружения.")
+
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+
+    if RUN_MODE == "sharded":
+        await run_sharded(bot, dp)
+    elif RUN_MODE == "webhook":
+        await run_webhook(bot, dp)
+    else:
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
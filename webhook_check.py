@@ -0,0 +1,113 @@
+"""
+Проверка режима webhook без Telegram.
+
+Поднимает настоящее aiohttp-приложение бота (build_webhook_app, а также
+вебхук фронта из шардированного режима) на локальном порту и шлёт в него
+синтетические апдейты, как это делал бы Telegram. Ответы бота уходят в
+записывающую сессию из bench.py, сеть не нужна.
+
+Запуск:
+    python webhook_check.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from bench import Scenario, build_session_class, prepare_env
+
+SECRET = "local-secret"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def wait_for(predicate, timeout: float = 5.0) -> bool:
+    # SimpleRequestHandler отвечает сразу, а апдейт обрабатывает в фоне
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def check_bot_app(main, session) -> list:
+    from aiogram import Bot
+    from aiohttp.test_utils import TestClient, TestServer
+
+    bot = Bot(token=os.environ["TGTOKEN"], session=session)
+    app = main.build_webhook_app(bot, main.create_dispatcher())
+    user = Scenario(10 ** 6)
+    failures = []
+
+    async with TestClient(TestServer(app)) as client:
+        resp = await client.get("/health")
+        if resp.status != 200:
+            failures.append(f"/health: {resp.status}")
+
+        for headers, label in (({}, "без секрета"), ({SECRET_HEADER: "wrong"}, "с чужим секретом")):
+            resp = await client.post(main.WEBHOOK_PATH, json=user.message("/start"), headers=headers)
+            if resp.status != 401:
+                failures.append(f"апдейт {label}: {resp.status}, ожидался 401")
+        await asyncio.sleep(0.1)
+        if session.calls:
+            failures.append(f"апдейт без секрета дошёл до бота: {dict(session.calls)}")
+
+        resp = await client.post(
+            main.WEBHOOK_PATH, json=user.message("/start"), headers={SECRET_HEADER: SECRET}
+        )
+        if resp.status != 200:
+            failures.append(f"апдейт с секретом: {resp.status}")
+        elif not await wait_for(lambda: session.calls["SendMessage"] == 1):
+            failures.append(f"бот не ответил на /start: {dict(session.calls)}")
+    return failures
+
+
+async def check_front_app(main, session) -> list:
+    from aiogram import Bot
+    from aiohttp.test_utils import TestClient, TestServer
+
+    routed = []
+    bot = Bot(token=os.environ["TGTOKEN"], session=session)
+    app = main.build_front_app(bot, routed.append, ["message"])
+    raw = Scenario(10 ** 6 + 1).message("/start")
+    failures = []
+
+    async with TestClient(TestServer(app)) as client:
+        resp = await client.get("/health")
+        if resp.status != 200:
+            failures.append(f"фронт /health: {resp.status}")
+        resp = await client.post(main.WEBHOOK_PATH, json=raw)
+        if resp.status != 401 or routed:
+            failures.append(f"фронт без секрета: {resp.status}, раздано {len(routed)}")
+        resp = await client.post(main.WEBHOOK_PATH, json=raw, headers={SECRET_HEADER: SECRET})
+        if resp.status != 200 or routed != [raw]:
+            failures.append(f"фронт с секретом: {resp.status}, раздано {len(routed)}")
+    return failures
+
+
+async def run() -> list:
+    import main
+
+    failures = await check_bot_app(main, build_session_class()())
+    failures += await check_front_app(main, build_session_class()())
+    return failures
+
+
+def main_cli():
+    with tempfile.TemporaryDirectory(prefix="zayavki-webhook-") as workdir:
+        # WEBHOOK_URL не задаём: регистрировать вебхук в Telegram не нужно
+        os.environ["WEBHOOK_SECRET"] = SECRET
+        os.environ.pop("WEBHOOK_URL", None)
+        prepare_env(workdir)
+        failures = asyncio.run(run())
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("webhook: OK" if not failures else f"webhook: ошибок {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main_cli()